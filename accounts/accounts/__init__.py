@@ -14,17 +14,37 @@ SYNOPSIS
 DESCRIPTION
 ===========
 Реализованы следующие методы:
-GET /users - получить список зарегистрированных пользователей;
+GET /users - получить список зарегистрированных пользователей; курсор следующей 
+страницы возвращается в заголовке `X-Next-Cursor` и передается в параметре `cursor`;
+фильтры задаются параметрами `filter=attr:op:value`, сортировка - параметром `sort`,
+набор возвращаемых атрибутов - параметром `fields`, интервал времени создания -
+параметрами `created_after` и `created_before`; параметр `count=exact` или
+`count=estimated` возвращает в заголовке `X-Total-Count` точное число пользователей или
+оценку планировщика PostgreSQL;
 POST /users - создать и зарегистрировать пользователя;
-GET /users/{id} - получить данные пользователя по id;
+GET /users/export - выгрузить всех пользователей в формате NDJSON (потоково, доступно
+суперпользователю);
+POST /users/bulk - создать несколько пользователей, ошибки отдельных элементов 
+возвращаются в ответе;
+DELETE /users/bulk - удалить несколько пользователей по списку id;
+GET /users/{id} - получить данные пользователя по id, параметр `fields` ограничивает
+набор возвращаемых атрибутов;
 PUT /users/{id} - обновить данные потльзователя с заданным id;
 DELETE /users/{id} - удалить пользователя с заданным id;
-GET /users/email/{email} - получить данные пользователя с заданным Email;
+GET /users/email/{email} - получить данные пользователя с заданным Email (без учета
+регистра);
 POST /login - авторизация пользователя по логину и паролю с выдачей `access_token`
 и `refresh_token`. Время жизни `access_token` устанавливается в минутах в конфигурационном
-файле `app.app.config`;
+файле `app.app.config`. Число попыток входа и регистрации ограничено для адреса
+клиента и для email (ответ 429), число одновременно проверяемых паролей - общим лимитом
+(ответ 503); оба ответа содержат заголовок `Retry-After`;
 GET /refresh_token - получение нового `access_token` путем отправки имеющегося 
-`refresh_token`.
+`refresh_token`;
+GET /stats - получить метрики сервиса (пул хэширования паролей и т.п.), доступно
+суперпользователю;
+GET /metrics - получить метрики в текстовом формате Prometheus: гистограммы времени
+обработки запросов по маршрутам, выполнения запросов к БД, ожидания соединения пула и
+хэширования паролей, занятость пула соединений.
 
 OpenAPI документация доступна по адресу /docs/
 
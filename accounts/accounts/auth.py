@@ -18,29 +18,53 @@ DESCRIPTION
 ===========
 Модуль, содержащий класс Auth, имеющий в своем составе методы для верификации
 пароля пользователя, кодирования и декодирования access и refresh токенов.
+Клиенты повторяют один и тот же access токен в каждом запросе, поэтому результат
+проверки подписи кэшируется по дайджесту токена до истечения срока его действия
+(`TOKEN_CACHE_SIZE` в `app.app.config`).
 
 MODEL
 ======
 """
 
+import hashlib
 import os
+import time
 import jwt
 from fastapi import HTTPException
 from datetime import datetime, timedelta
-from passlib.context import CryptContext
 
-from app.app.config import TOKEN_EXP_TIME
+from app.app.cache import TTLCache
+from app.app.config import TOKEN_EXP_TIME, settings
 from .models import User
+from .hashing import hasher
+
+
+# Кэш проверенных токенов: дайджест токена -> (scope, sub). Время жизни записи равно
+# оставшемуся сроку действия токена
+token_cache = TTLCache(settings.TOKEN_CACHE_SIZE, TOKEN_EXP_TIME * 60)
 
 
 class Auth():
     """Класс, реализующий методы верификации пароля, кодирования и декодирования jwt-токена"""
     secret = os.getenv("AUTH_SECRET_STRING")
-    hasher= CryptContext(schemes=['bcrypt'])
 
     async def verify_password(self, password, encoded_password):
-        """Верификация пароля"""
-        return self.hasher.verify(password, encoded_password)
+        """Верификация пароля в пуле хэширования"""
+        return await hasher.verify(password, encoded_password)
+
+    @staticmethod
+    def subject(user):
+        """
+        Утверждения о пользователе, включаемые в токены. Флаги и версия токенов
+        позволяют проверять права доступа без обращения к БД.
+        """
+        return {
+            "username": user.email,
+            "user_id": str(user.id),
+            "is_active": user.is_active,
+            "is_superuser": user.is_superuser,
+            "token_version": user.token_version,
+        }
 
     async def encode_token(self, user):
         """Кодирование access токена"""
@@ -48,10 +72,7 @@ class Auth():
             'exp' : datetime.utcnow() + timedelta(days=0, minutes=TOKEN_EXP_TIME),
             'iat' : datetime.utcnow(),
             'scope': 'access_token',
-            'sub' : {
-                        "username": user.email,
-                        "user_id": str(user.id)
-                    }
+            'sub' : self.subject(user)
         }
         return jwt.encode(
             payload, 
@@ -60,16 +81,28 @@ class Auth():
         )
 
     async def decode_token(self, token):
-        """Декодирование access токена"""
-        try:
-            payload = jwt.decode(token, self.secret, algorithms=['HS256'])
-            if (payload['scope'] == 'access_token'):
-                return payload['sub']   
-            raise HTTPException(status_code=401, detail='Scope for the token is invalid')
-        except jwt.ExpiredSignatureError:
-            raise HTTPException(status_code=401, detail='Token expired')
-        except jwt.InvalidTokenError:
-            raise HTTPException(status_code=401, detail='Invalid token')
+        """
+        Декодирование access токена. Подпись проверяется при первом предъявлении токена,
+        далее результат берется из кэша до истечения срока действия токена.
+        """
+        key = hashlib.sha256(token.encode()).digest()
+        entry = token_cache.get(key)
+        if entry is None:
+            try:
+                payload = jwt.decode(token, self.secret, algorithms=['HS256'])
+            except jwt.ExpiredSignatureError:
+                raise HTTPException(status_code=401, detail='Token expired')
+            except jwt.InvalidTokenError:
+                raise HTTPException(status_code=401, detail='Invalid token')
+            entry = (payload['scope'], payload['sub'])
+            ttl = payload['exp'] - time.time()
+            if ttl > 0:
+                token_cache.set(key, entry, ttl)
+        scope, sub = entry
+        if (scope == 'access_token'):
+            # Копия, чтобы изменения вызывающим кодом не попали в кэш
+            return dict(sub)
+        raise HTTPException(status_code=401, detail='Scope for the token is invalid')
 
     async def encode_refresh_token(self, user):
         """Кодирование refresh токена"""
@@ -77,10 +110,7 @@ class Auth():
             'exp' : datetime.utcnow() + timedelta(days=0, hours=10),
             'iat' : datetime.utcnow(),
             'scope': 'refresh_token',
-            'sub' : {
-                        "username": user.email,
-                        "user_id": str(user.id)
-                    }
+            'sub' : self.subject(user)
         }
         return jwt.encode(
             payload, 
@@ -88,17 +118,17 @@ class Auth():
             algorithm='HS256'
         )
 
-    async def refresh_token(self, refresh_token):
-        """Декодировнаие refresh токена"""
+    async def decode_refresh_token(self, refresh_token):
+        """
+        Декодирование refresh токена. Возвращает утверждения о пользователе; новый access
+        токен выдается по данным пользователя из БД, а не по этим утверждениям.
+        """
         try:
             payload = jwt.decode(refresh_token, self.secret, algorithms=['HS256'])
-            if (payload['scope'] == 'refresh_token'):
-                sub = payload['sub']
-                user = User(id=sub['user_id'], email=sub['username'])
-                new_token = await self.encode_token(user)
-                return new_token
-            raise HTTPException(status_code=401, detail='Invalid scope for token')
         except jwt.ExpiredSignatureError:
             raise HTTPException(status_code=401, detail='Refresh token expired')
         except jwt.InvalidTokenError:
             raise HTTPException(status_code=401, detail='Invalid refresh token')
+        if (payload['scope'] == 'refresh_token'):
+            return payload['sub']
+        raise HTTPException(status_code=401, detail='Invalid scope for token')
@@ -10,35 +10,186 @@ VERSION
 SYNOPSIS
 ========
 
-    from accounts.db import get_db, Base
+    from accounts.db import get_db, get_sessionmaker, Base, DBSessionMiddleware
+
+    await warm_up(settings.DB_POOL_WARMUP, prime)
+
+    app.add_middleware(DBSessionMiddleware)
 
 DESCRIPTION
 ===========
 Модуль, осуществляющий асинхронное подключение к БД и содержащий генератор сессий.
+Сессия создается одна на запрос в `DBSessionMiddleware`: все методы `BaseActions`,
+вызванные при обработке запроса, выполняются в одной транзакции на одном соединении.
+Транзакция фиксируется перед отправкой успешного ответа и откатывается при ошибке.
+Параметры пула соединений задаются в `app.app.config`. Движки и фабрика сессий
+создаются при первом обращении (`get_engine`, `get_sessionmaker`), а не при импорте;
+`warm_up` открывает соединения пула и заполняет кэши запросов при запуске приложения.
+
+Если заданы адреса реплик `SQLALCHEMY_REPLICA_URIS`, запросы методов чтения
+`BaseActions` выполняются на исправной реплике с отставанием не больше
+`REPLICA_MAX_LAG` секунд, запись и чтение после записи в той же сессии - на основной БД.
+Если исправных реплик нет, чтение выполняется на основной БД.
+
+Движки собирают метрики `app.app.metrics`: время выполнения запросов, время ожидания
+соединения и занятость пула. Запросы не выводятся в stdout (`echo`): журнал `app.sql`
+получает выборку запросов и все медленные запросы с формой параметров, а при превышении
+числа запросов на HTTP-запрос (`QUERY_BUDGET`) - предупреждение.
 
 MODEL
 ======
 """
 
+import asyncio
+
+from fastapi import Request
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 from app.app.config import settings
+from app.app.metrics import TimedPool, instrument_engine
+from app.app.query_logging import QueryLogger
+from app.app.replicas import ReplicaPool, RoutingSession
+
+
+# Журнал запросов: выборка запросов, медленные запросы и бюджет запросов на HTTP-запрос
+query_logger = QueryLogger(settings.QUERY_LOG_SAMPLE_RATE, settings.QUERY_LOG_SLOW_MS / 1000,
+                           settings.QUERY_BUDGET)
+
+# Движки, реплики и фабрика сессий создаются при первом обращении
+_engine = None
+_replicas = None
+_session_factory = None
+
+
+def create_engine(uri: str, name: str):
+    """Создать движок с параметрами пула из `app.app.config`, метриками и журналом"""
+    engine = create_async_engine(uri, pool_pre_ping=True,
+                                 poolclass=TimedPool,
+                                 pool_size=settings.DB_POOL_SIZE,
+                                 max_overflow=settings.DB_MAX_OVERFLOW,
+                                 pool_timeout=settings.DB_POOL_TIMEOUT,
+                                 pool_recycle=settings.DB_POOL_RECYCLE)
+    instrument_engine(engine, name)
+    query_logger.instrument(engine, name)
+    return engine
+
+
+def get_engine():
+    """Движок основной БД"""
+    global _engine
+    if _engine is None:
+        _engine = create_engine(settings.SQLALCHEMY_DATABASE_URI, 'primary')
+    return _engine
+
+
+def get_replicas() -> ReplicaPool:
+    """Реплики для чтения, проверяются периодически после запуска приложения"""
+    global _replicas
+    if _replicas is None:
+        _replicas = ReplicaPool(
+            [create_engine(uri, f'replica{index}')
+             for index, uri in enumerate(settings.SQLALCHEMY_REPLICA_URIS)],
+            selection=settings.REPLICA_SELECTION,
+            max_lag=settings.REPLICA_MAX_LAG,
+            interval=settings.REPLICA_CHECK_INTERVAL,
+        )
+    return _replicas
+
+
+def get_sessionmaker() -> sessionmaker:
+    """Фабрика сессий подключения к БД"""
+    global _session_factory
+    if _session_factory is None:
+        _session_factory = sessionmaker(get_engine(), class_=AsyncSession,
+                                        sync_session_class=RoutingSession,
+                                        replicas=get_replicas(), expire_on_commit=False)
+    return _session_factory
 
 
-engine = create_async_engine(settings.SQLALCHEMY_DATABASE_URI, pool_pre_ping=True, echo=True)
-SessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+def __getattr__(name: str):
+    """Прежние имена модуля `engine`, `replicas` и `SessionLocal` для скриптов и тестов"""
+    if name == 'engine':
+        return get_engine()
+    if name == 'replicas':
+        return get_replicas()
+    if name == 'SessionLocal':
+        return get_sessionmaker()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+async def warm_up(connections: int, prime=None):
+    """
+    Открыть `connections` соединений пула основной БД, не больше `DB_POOL_SIZE`, и
+    выполнить на каждом соединении в отдельной сессии корутину `prime(db)`, чтобы
+    скомпилированные запросы и подготовленные операторы asyncpg были в кэшах до
+    первого запроса
+    """
+
+    async def open_session():
+        async with get_sessionmaker()() as db:
+            if prime is not None:
+                await prime(db)
+            else:
+                await db.connection()
+            await db.rollback()
+
+    await asyncio.gather(*(open_session()
+                           for _ in range(min(connections, settings.DB_POOL_SIZE))))
+
+
+async def dispose():
+    """Закрыть соединения пулов основной БД"""
+    if _engine is not None:
+        await _engine.dispose()
+
 
 # Базовый класс для моделей
 Base = declarative_base()
 
 
-def get_db():
-    """Генератор сессий подключения к БД"""
-    try:
-        db = SessionLocal()
-        yield db
-    finally:
-        pass
+class DBSessionMiddleware():
+    """
+    ASGI middleware, создающее сессию подключения к БД на время запроса. Транзакция
+    фиксируется перед отправкой ответа со статусом меньше 400, иначе откатывается.
+    Запросы к БД, выполненные при обработке запроса, считаются в `query_logger`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        token = query_logger.start_request()
+        try:
+            await self._call(scope, receive, send)
+        finally:
+            query_logger.finish_request(token, scope['method'], scope['path'])
+
+    async def _call(self, scope, receive, send):
+        async with get_sessionmaker()() as db:
+            scope.setdefault('state', {})['db'] = db
+
+            async def send_wrapper(message):
+                if message['type'] == 'http.response.start':
+                    if message['status'] < 400:
+                        await db.commit()
+                    else:
+                        await db.rollback()
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            except Exception:
+                await db.rollback()
+                raise
+
+
+def get_db(request: Request):
+    """Сессия подключения к БД текущего запроса"""
+    return request.state.db
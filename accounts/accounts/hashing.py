@@ -0,0 +1,181 @@
+"""
+NAME
+====
+hashing - модуль хэширования и верификации паролей в отдельном пуле воркеров
+
+VERSION
+=======
+0.1.0
+
+SYNOPSIS
+========
+
+    from accounts.hashing import hasher
+
+    encoded_password = await hasher.hash(password)
+    is_valid = await hasher.verify(password, encoded_password)
+
+DESCRIPTION
+===========
+Хэширование bcrypt занимает сотни миллисекунд процессорного времени. Вызванное прямо
+в асинхронном обработчике, оно блокирует цикл событий, и все остальные запросы ждут.
+Модуль выполняет операции passlib в пуле потоков или процессов (`HASHING_EXECUTOR`),
+размер которого задается параметром `HASHING_WORKERS` в `app.app.config`. Число
+ожидающих операций ограничено параметром `HASHING_MAX_QUEUE`: при переполнении
+очереди запрос сразу получает ответ 503 вместо бесконечного ожидания.
+
+MODEL
+======
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
+
+from app.app.config import settings
+from app.app.metrics import Counter, Gauge, Histogram, registry
+
+
+# Контекст passlib и функции ниже объявлены на уровне модуля, чтобы их можно было
+# передать в пул процессов
+crypt_context = CryptContext(schemes=['bcrypt'])
+
+
+def hash_password(password: str) -> str:
+    """Получить bcrypt-хэш пароля"""
+    return crypt_context.hash(password)
+
+
+def verify_password(password: str, encoded_password: str) -> bool:
+    """Сверить пароль с bcrypt-хэшем"""
+    return crypt_context.verify(password, encoded_password)
+
+
+def load_backend() -> str:
+    """Загрузить реализацию bcrypt, которую passlib иначе загружает при первом хэшировании"""
+    return crypt_context.handler('bcrypt').get_backend()
+
+
+hashing_duration = registry.register(Histogram(
+    'password_hashing_duration_seconds', 'bcrypt hash/verify duration including queueing',
+    ('operation',), buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+))
+hashing_rejected = registry.register(Counter(
+    'password_hashing_rejected_total', 'Hashing operations rejected because the queue was full',
+))
+
+
+class Hasher():
+    """Класс, выполняющий хэширование и верификацию паролей в пуле воркеров"""
+
+    def __init__(self, executor_type: str = 'thread', workers: Optional[int] = None,
+                 max_queue: int = 128):
+        self.executor_type = executor_type
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self._executor: Optional[Executor] = None
+        self._pending = 0
+        self._counters = {
+            'hash_total': 0,
+            'hash_seconds_total': 0.0,
+            'verify_total': 0,
+            'verify_seconds_total': 0.0,
+            'rejected_total': 0,
+        }
+
+    @property
+    def executor(self) -> Executor:
+        """Пул воркеров, создается при первом обращении"""
+        if self._executor is None:
+            if self.executor_type == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='hasher')
+        return self._executor
+
+    async def _run(self, operation: str, func, *args) -> Any:
+        """Выполнить `func` в пуле с учетом ограничения глубины очереди"""
+        if self._pending >= self.max_queue:
+            self._counters['rejected_total'] += 1
+            hashing_rejected.inc()
+            raise HTTPException(
+                status_code=HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Password hashing queue is full',
+                headers={'Retry-After': '1'},
+            )
+        self._pending += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._pending -= 1
+            self._counters[f'{operation}_total'] += 1
+            self._counters[f'{operation}_seconds_total'] += elapsed
+            hashing_duration.observe(elapsed, operation)
+
+    async def hash(self, password: str) -> str:
+        """Получить bcrypt-хэш пароля"""
+        return await self._run('hash', hash_password, password)
+
+    async def hash_many(self, passwords: Sequence[str]) -> List[Union[str, Exception]]:
+        """
+        Получить bcrypt-хэши паролей параллельно, занимая в очереди не больше `workers`
+        мест. Для паролей, которые не удалось обработать, возвращается исключение.
+        """
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def hash_one(password):
+            async with semaphore:
+                return await self.hash(password)
+
+        return await asyncio.gather(*(hash_one(password) for password in passwords),
+                                    return_exceptions=True)
+
+    async def verify(self, password: str, encoded_password: str) -> bool:
+        """Сверить пароль с bcrypt-хэшем"""
+        return await self._run('verify', verify_password, password, encoded_password)
+
+    async def warm_up(self):
+        """
+        Запустить воркеры пула и загрузить в них реализацию bcrypt до первого запроса.
+        Задачи отправляются в пул одновременно, поэтому каждая занимает отдельный воркер.
+        """
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.executor, load_backend)
+                               for _ in range(self.workers)))
+
+    def metrics(self) -> Dict[str, Any]:
+        """Текущее состояние пула и накопленные счетчики"""
+        return {
+            'executor': self.executor_type,
+            'workers': self.workers,
+            'max_queue': self.max_queue,
+            'in_flight': min(self._pending, self.workers),
+            'queued': max(self._pending - self.workers, 0),
+            **self._counters,
+        }
+
+    def shutdown(self):
+        """Остановить пул воркеров"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+# Экземпляр пула хэширования для использования в Auth и User
+hasher = Hasher(settings.HASHING_EXECUTOR, settings.HASHING_WORKERS, settings.HASHING_MAX_QUEUE)
+
+registry.register(Gauge(
+    'password_hashing_operations', 'Hashing operations in flight and queued', ('state',),
+    callback=lambda: {('in_flight',): hasher.metrics()['in_flight'],
+                      ('queued',): hasher.metrics()['queued']},
+))
@@ -15,6 +15,9 @@ DESCRIPTION
 Модуль, содержит методы API:
     GET /users - получить список пользователей
     POST /users - создать пользователя
+    GET /users/export - выгрузить всех пользователей в формате NDJSON
+    POST /users/bulk - создать несколько пользователей
+    DELETE /users/bulk - удалить несколько пользователей
     PUT /users/{id} - изменить поля записи пользователя с идентификатором id
     GET /users/{id} - получить запись пользователя с идентификатором id
     GET /users/email/{email} - получить запись пользователя, имеющего электронный 
@@ -22,79 +25,339 @@ DESCRIPTION
     DELETE /users/{id} - удалить запись пользователя, имеющего идентификатор id
     POST /login - аутентификацич пользователя по логину и паролю
     GET /refresh_token - обновить токен доступа
+    GET /stats - получить метрики сервиса
+    GET /metrics - получить метрики в формате Prometheus
 
 MODEL
 ======
 """
 
-from typing import Any, List
+import asyncio
+from datetime import datetime, timezone
+from typing import Any, List, Optional
+from uuid import uuid4
 
-from fastapi import Depends, FastAPI, HTTPException, Security
+from fastapi import Depends, FastAPI, HTTPException, Query, Security
 from pydantic import UUID4
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from fastapi import Request
 from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from starlette.status import (HTTP_201_CREATED, HTTP_404_NOT_FOUND,
-                              HTTP_400_BAD_REQUEST,)
+                              HTTP_400_BAD_REQUEST, HTTP_422_UNPROCESSABLE_ENTITY,)
 from typing import TypeVar
 
 from . import schemas
-from .db import get_db
+from .db import (get_db, get_sessionmaker, get_replicas, warm_up, dispose,
+                 DBSessionMiddleware)
 from .models import User
-from .auth import Auth
-from . permissions import get_current_user, auth_required
+from .auth import Auth, token_cache
+from .hashing import hasher
+from .revocation import revocation_list
+from . permissions import get_refresh_user, auth_required, principal_cache
 
 from app.app import actions
+from app.app.admission import Admission, RateLimiter
+from app.app.config import settings
+from app.app.metrics import TimedRoute, registry
+from app.app.query import (Filter, QuerySpec, parse_fields, parse_filter, parse_order_by,
+                           query_compiler)
+from app.app.serialization import FastJSONResponse, compile_serializer, dumps
+from app.app.write_behind import WriteBehindBuffer
+
+
+# Код ошибки PostgreSQL unique_violation
+UNIQUE_VIOLATION = '23505'
 
 
 class UserActions(actions.BaseActions[schemas.User, schemas.UserCreated, schemas.UserUpdate]):
     """Класс UserActions с базовыми CRUD операциями"""
 
-    pass
+    # Атрибуты, по которым допускаются фильтрация и сортировка в GET /users
+    query_attrs = ('id', 'email', 'first_name', 'last_name', 'is_active', 'is_verified',
+                   'is_superuser', 'created', 'last_login')
 
 # Экземпляр класса UserAction для использования в методах
 user_actions = UserActions()
 
+# Сериализатор объектов User в ответах без повторной валидации данных из БД
+serialize_user = compile_serializer(schemas.User)
+
+# Буфер отложенной записи времени последнего входа пользователей
+activity_buffer = WriteBehindBuffer(User, settings.ACTIVITY_FLUSH_INTERVAL,
+                                    settings.ACTIVITY_BUFFER_SIZE)
+
+
+# Допуск запросов к обработчикам, хэширующим пароли: POST /login и POST /users
+auth_admission = Admission(
+    'auth', settings.ADMISSION_CONCURRENCY, settings.ADMISSION_MAX_QUEUE,
+    settings.ADMISSION_TIMEOUT,
+    clients=RateLimiter(settings.RATE_LIMIT_CLIENT_RATE, settings.RATE_LIMIT_CLIENT_BURST,
+                        settings.RATE_LIMIT_SIZE),
+    keys=RateLimiter(settings.RATE_LIMIT_EMAIL_RATE, settings.RATE_LIMIT_EMAIL_BURST,
+                     settings.RATE_LIMIT_SIZE),
+)
+
+
+def client_address(request: Request) -> Optional[str]:
+    """Адрес клиента для ограничения частоты запросов"""
+    return request.client.host if request.client else None
 
-app = FastAPI()
+
+app = FastAPI(default_response_class=FastJSONResponse)
+# Маршруты измеряют время обработки запросов для GET /metrics
+app.router.route_class = TimedRoute
+app.add_middleware(DBSessionMiddleware)
 
 
 security = HTTPBearer()
 auth_handler = Auth()
 
 
+def rows_response(rows, fields, headers=None) -> FastJSONResponse:
+    """
+    Ответ со строками-словарями, содержащими только атрибуты `fields`, без создания
+    объектов ORM и валидации схемой
+    """
+    return FastJSONResponse([{field: row[field] for field in fields} for row in rows],
+                            headers=headers)
+
+
+async def prime_statements(db: Session):
+    """
+    Выполнить запросы, с которых начинается обработка большинства запросов: поиск
+    пользователя по id (авторизация, GET /users/{id}) и по email (POST /login)
+    """
+    await user_actions.get_by_attr_first(User, uuid4(), 'id', db=db)
+    await user_actions.get_by_attr_lower_first(User, '', 'email', db=db)
+
+
+@app.on_event("startup")
+async def startup():
+    """
+    Запуск проверки реплик, отложенной записи времени последнего входа и загрузка
+    списка отзыва токенов в режиме авторизации без обращения к БД. До готовности
+    приложения открываются `DB_POOL_WARMUP` соединений пула с заполнением кэшей
+    запросов и запускаются воркеры хэширования паролей. После этого поиск
+    авторизованных пользователей по id одновременными запросами объединяется
+    загрузчиком `BaseActions.loader`.
+    """
+    replicas = get_replicas()
+    await replicas.start()
+    await asyncio.gather(warm_up(settings.DB_POOL_WARMUP, prime_statements),
+                         hasher.warm_up())
+    await activity_buffer.start(get_sessionmaker())
+    actions.BaseActions.loader.start()
+    if settings.AUTH_STATELESS:
+        await revocation_list.start(get_sessionmaker())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Остановка фоновых задач с записью отложенных изменений и пула хэширования паролей"""
+    actions.BaseActions.loader.stop()
+    await revocation_list.stop()
+    await activity_buffer.stop()
+    await get_replicas().stop()
+    await dispose()
+    hasher.shutdown()
+
+
 @app.get("/users", response_model=List[schemas.User], tags=["users"])
 @auth_required('is_superuser')
 async def list_users(*, db: Session = Depends(get_db), skip: int = 0, limit: int = 100,
+                     cursor: Optional[str] = None,
+                     filters: Optional[List[str]] = Query(None, alias='filter'),
+                     sort: Optional[str] = None, fields: Optional[str] = None,
+                     count: Optional[str] = Query(None, regex='^(exact|estimated)$'),
+                     created_after: Optional[datetime] = None,
+                     created_before: Optional[datetime] = None,
                      credentials: HTTPAuthorizationCredentials = Security(security)) -> Any:
-    """Метод GET /users - получить список пользователей"""
+    """
+    Метод GET /users - получить список пользователей.
+    Без `skip` используется постраничная выборка по курсору: курсор следующей страницы
+    возвращается в заголовке `X-Next-Cursor` и передается в параметре `cursor`.
+    Фильтры задаются параметрами `filter=attr:op:value` (op - eq, in, gt, gte, lt, lte,
+    prefix только для строковых атрибутов, is_null), сортировка - параметром `sort=-created,email`; в этом случае
+    используется постраничная выборка по `skip` и `limit`.
+    Параметр `fields=id,email` ограничивает набор возвращаемых атрибутов: выбираются
+    только эти колонки, строки возвращаются без создания объектов ORM.
+    Параметры `created_after` и `created_before` (ISO 8601, без часового пояса - UTC)
+    ограничивают время создания: created >= created_after и created < created_before;
+    выборка использует индекс (created, id).
+    Параметр `count` возвращает в заголовке `X-Total-Count` число пользователей,
+    удовлетворяющих фильтрам: `exact` - точное (SELECT count(*)), `estimated` - оценку
+    планировщика PostgreSQL без чтения таблицы, кэшируемую на `COUNT_ESTIMATE_TTL` секунд.
+    Объекты сериализуются заранее построенным сериализатором без валидации pydantic.
+    """
 
-    users = await user_actions.get_all(User, 'created',db=db, skip=skip, limit=limit)
-    return users
+    field_list = parse_fields(fields)
+    headers = {}
+    try:
+        filter_list = [parse_filter(item) for item in filters or []]
+        for op, value in (('gte', created_after), ('lt', created_before)):
+            if value is not None:
+                filter_list.append(Filter(attr='created', op=op, value=value))
+        if filter_list or sort:
+            spec = QuerySpec(filters=filter_list,
+                             order_by=parse_order_by(sort) or ['-created'],
+                             fields=field_list)
+            users = await user_actions.get_by_query_all(User, spec, db=db, skip=skip, limit=limit)
+        elif skip:
+            users = await user_actions.get_all(User, 'created',db=db, skip=skip, limit=limit,
+                                               fields=field_list)
+        else:
+            users, next_cursor = await user_actions.get_all_by_cursor(User, 'created', db=db,
+                                                                      cursor=cursor, limit=limit,
+                                                                      fields=field_list)
+            if next_cursor:
+                headers['X-Next-Cursor'] = next_cursor
+        if count:
+            total = await user_actions.count(User, db=db, query=QuerySpec(filters=filter_list),
+                                             mode=count)
+            headers['X-Total-Count'] = str(total)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
+    if field_list:
+        return rows_response(users, field_list, headers=headers)
+    return FastJSONResponse([serialize_user(user) for user in users], headers=headers)
 
 
 @app.post(
     "/users", response_model=schemas.UserCreated, status_code=HTTP_201_CREATED, tags=["users"]
 )
-async def create_user(*, db: Session = Depends(get_db), user_in: schemas.UserCreating) -> Any:
+async def create_user(*, db: Session = Depends(get_db), user_in: schemas.UserCreating,
+                      request: Request) -> Any:
     """
     Метод POST /users - создать пользователя.
+    Запись создается одним запросом INSERT ... ON CONFLICT по уникальному индексу
+    lower(email), поэтому одновременные регистрации с одним email не создают дубликатов.
+    Запрос проходит допуск `auth_admission`: при перегрузке - ответ 429 или 503.
     TO DO: Реализовать в auth.py валидацию пароля по сложности при создании.
     """
 
     user_in_data = jsonable_encoder(user_in)
-    user = await user_actions.get_by_attr_first(User, user_in_data['email'], 'email', db=db)
-    if user:
+    async with auth_admission.admit(client_address(request), user_in_data['email'].lower()):
+        user = await user_actions.create_if_absent(
+            User,
+            {**user_in_data,
+             'password': await hasher.hash(user_in_data['password']),
+             'is_verified': False,
+             'is_superuser': False,
+             'created': datetime.now(timezone.utc)},
+            db=db,
+            index_elements=[func.lower(User.email)],
+        )
+    if not user:
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="User with same email already exist")
-    db_user = User(**user_in_data)
-    db_user.set_password(user_in_data['password'])
-    db_user.set_is_verified_false()
-    db_user.set_is_superuser_false()
-    db_user.set_created()
-    user = await user_actions.create(db=db, db_obj=db_user)
-    return {'id': user.id,
-            'email': user.email}
+    return {'id': user['id'],
+            'email': user['email']}
+
+
+@app.get("/users/export", response_class=StreamingResponse, tags=["users"])
+@auth_required('is_superuser')
+async def export_users(*, db: Session = Depends(get_db),
+                       credentials: HTTPAuthorizationCredentials = Security(security)) -> Any:
+    """
+    Метод GET /users/export - выгрузить всех пользователей в формате NDJSON.
+    Строки передаются клиенту по мере чтения из БД серверным курсором.
+    """
+
+    fetch_size = settings.EXPORT_FETCH_SIZE
+
+    async def export_lines():
+        lines = []
+        async for user in user_actions.stream_all(User, 'created', db=db, fetch_size=fetch_size):
+            lines.append(dumps(serialize_user(user)))
+            if len(lines) >= fetch_size:
+                yield b'\n'.join(lines) + b'\n'
+                lines = []
+        if lines:
+            yield b'\n'.join(lines) + b'\n'
+
+    return StreamingResponse(export_lines(), media_type='application/x-ndjson')
+
+
+@app.post("/users/bulk", response_model=schemas.UsersBulkCreated, tags=["users"])
+@auth_required('is_superuser')
+async def create_users_bulk(*, db: Session = Depends(get_db),
+                            users_in: schemas.UsersBulkCreating,
+                            credentials: HTTPAuthorizationCredentials = Security(security)) -> Any:
+    """
+    Метод POST /users/bulk - создать несколько пользователей.
+    Пароли хэшируются параллельно, записи вставляются многострочными INSERT ... ON
+    CONFLICT по уникальному индексу lower(email), поэтому одновременные регистрации с
+    теми же email не приводят к ошибке всего запроса. Ошибки отдельных элементов
+    возвращаются в списке `errors` с индексом элемента.
+    """
+
+    users_in_data = jsonable_encoder(users_in.users)
+    errors = []
+    seen_emails = set()
+    candidates = []
+    for index, user_in_data in enumerate(users_in_data):
+        if user_in_data['email'].lower() in seen_emails:
+            errors.append({'index': index, 'detail': "Duplicate email in request"})
+            continue
+        seen_emails.add(user_in_data['email'].lower())
+        candidates.append((index, user_in_data))
+
+    existing_users = await user_actions.get_by_attr_lower_in(
+        User, [user_in_data['email'] for _, user_in_data in candidates], 'email', db=db
+    )
+    existing_emails = {user.email.lower() for user in existing_users}
+    new_users = []
+    for index, user_in_data in candidates:
+        if user_in_data['email'].lower() in existing_emails:
+            errors.append({'index': index, 'detail': "User with same email already exist"})
+        else:
+            new_users.append((index, user_in_data))
+
+    passwords = await hasher.hash_many([user_in_data['password'] for _, user_in_data in new_users])
+    created = datetime.now(timezone.utc)
+    rows = []
+    row_indexes = []
+    for (index, user_in_data), password in zip(new_users, passwords):
+        if isinstance(password, Exception):
+            errors.append({'index': index, 'detail': getattr(password, 'detail', str(password))})
+            continue
+        rows.append({**user_in_data,
+                     'password': password,
+                     'is_active': True,
+                     'is_verified': False,
+                     'is_superuser': False,
+                     'created': created})
+        row_indexes.append(index)
+
+    # Email, зарегистрированные после проверки выше, пропускаются по конфликту индекса
+    users = await user_actions.create_many(
+        User, rows, db=db, index_elements=[func.lower(User.email)]
+    ) if rows else []
+    created_emails = {user['email'].lower() for user in users}
+    for index, row in zip(row_indexes, rows):
+        if row['email'].lower() not in created_emails:
+            errors.append({'index': index, 'detail': "User with same email already exist"})
+    return {'created': [{'id': user['id'], 'email': user['email']} for user in users],
+            'errors': sorted(errors, key=lambda error: error['index'])}
+
+
+@app.delete("/users/bulk", response_model=schemas.UsersBulkDeleted, tags=["users"])
+@auth_required('is_superuser')
+async def delete_users_bulk(*, db: Session = Depends(get_db),
+                            users_in: schemas.UsersBulkDeleting,
+                            credentials: HTTPAuthorizationCredentials = Security(security)) -> Any:
+    """
+    Метод DELETE /users/bulk - удалить несколько пользователей.
+    Идентификаторы, для которых записи не найдены, возвращаются в списке `errors`.
+    """
+
+    deleted = set(await user_actions.remove_many(User, users_in.ids, db=db))
+    errors = [{'index': index, 'detail': "User not found"}
+              for index, id in enumerate(users_in.ids) if id not in deleted]
+    return {'deleted': [id for id in users_in.ids if id in deleted], 'errors': errors}
 
 
 @app.put(
@@ -108,16 +371,26 @@ async def update_user(*, db: Session = Depends(get_db), id: UUID4,
                       user_in: schemas.UserUpdate,
                       credentials: HTTPAuthorizationCredentials = Security(security),
                       request: Request) -> Any:
-    """Метод PUT /users/{id} - изменить поля записи пользователя с идентификатором id"""
+    """
+    Метод PUT /users/{id} - изменить поля записи пользователя с идентификатором id.
+    Переданные поля записываются одним запросом UPDATE ... RETURNING.
+    """
 
-    user = await user_actions.get_by_attr_first(User, id, 'id', db=db)
+    try:
+        user = await user_actions.update_by_id(User, id, user_in, db=db)
+    except IntegrityError as e:
+        # Нарушение уникального индекса ix_users_email_lower
+        if getattr(e.orig, 'pgcode', None) == UNIQUE_VIOLATION:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST,
+                                detail="User with same email already exist")
+        raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Invalid user data")
     if not user:
         raise HTTPException(
             status_code=HTTP_404_NOT_FOUND,
             detail="User not found",
         )
-    user = await user_actions.update(db=db, db_obj=user, obj_in=user_in)
-    return user
+    return dict(user)
 
 
 @app.get(
@@ -128,16 +401,29 @@ async def update_user(*, db: Session = Depends(get_db), id: UUID4,
 )
 @auth_required('is_superuser_or_is_owner')
 async def get_user_by_id(*, db: Session = Depends(get_db), id: UUID4,
+                         fields: Optional[str] = None,
                          credentials: HTTPAuthorizationCredentials = Security(security)) -> Any:
-    """Метод GET /users/{id} - получить запись пользователя с идентификатором id"""
+    """
+    Метод GET /users/{id} - получить запись пользователя с идентификатором id.
+    Параметр `fields=id,email` ограничивает набор возвращаемых атрибутов.
+    """
 
-    user = await user_actions.get_by_attr_first(User, id, 'id', db=db)
+    field_list = parse_fields(fields)
+    if field_list:
+        try:
+            user = await user_actions.get_row_by_attr_first(User, id, 'id', field_list, db=db)
+        except ValueError as e:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
+    else:
+        user = await user_actions.get_by_attr_first(User, id, 'id', db=db)
     if not user:
         raise HTTPException(
             status_code=HTTP_404_NOT_FOUND,
             detail="User not found",
         )
-    return user
+    if field_list:
+        return FastJSONResponse({field: user[field] for field in field_list})
+    return FastJSONResponse(serialize_user(user))
 
 
 @app.get(
@@ -151,16 +437,16 @@ async def get_user_by_email(*, db: Session = Depends(get_db), email: str,
                             credentials: HTTPAuthorizationCredentials = Security(security)) -> Any:
     """
     Метод GET /users/email/{email} - получить запись пользователя, имеющего электронный 
-    почтовый ящик email
+    почтовый ящик email. Email сравнивается без учета регистра.
     """
 
-    user = await user_actions.get_by_attr_first(User, email, 'email', db=db)
+    user = await user_actions.get_by_attr_lower_first(User, email, 'email', db=db)
     if not user:
         raise HTTPException(
             status_code=HTTP_404_NOT_FOUND,
             detail="User not found",
         )
-    return user
+    return FastJSONResponse(serialize_user(user))
 
 
 @app.delete(
@@ -190,19 +476,27 @@ async def delete_user(*, db: Session = Depends(get_db), id: UUID4,
     responses={HTTP_404_NOT_FOUND: {"model": schemas.HTTPError}},
     tags=["auth"],
 )
-async def login(*, db: Session = Depends(get_db), user_in: schemas.UserLogin):
-    """Метод POST /login - аутентификацич пользователя по логину и паролю"""
+async def login(*, db: Session = Depends(get_db), user_in: schemas.UserLogin,
+                request: Request):
+    """
+    Метод POST /login - аутентификацич пользователя по логину и паролю.
+    Запрос проходит допуск `auth_admission`: число попыток входа ограничено для адреса
+    клиента и для email, число одновременных проверок пароля - общим лимитом; при
+    перегрузке - ответ 429 или 503 с заголовком Retry-After.
+    """
 
     user_in_data = jsonable_encoder(user_in)
-    user = await user_actions.get_by_attr_first(User, user_in_data['email'], 'email', db=db)
-    if not user:
-        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="User not found")
-    if not await auth_handler.verify_password(user_in_data['password'], user.password):
-        raise HTTPException(status_code=401, detail='Invalid password')
+    async with auth_admission.admit(client_address(request), user_in_data['email'].lower()):
+        user = await user_actions.get_by_attr_lower_first(User, user_in_data['email'],
+                                                         'email', db=db)
+        if not user:
+            raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="User not found")
+        if not await auth_handler.verify_password(user_in_data['password'], user.password):
+            raise HTTPException(status_code=401, detail='Invalid password')
     access_token = await auth_handler.encode_token(user)
     refresh_token = await auth_handler.encode_refresh_token(user)
-    user.set_last_login()
-    await user_actions.update(db=db, db_obj=user, obj_in={'last_login': user.last_login})
+    # Время входа записывается в БД пакетно в фоне, вне транзакции запроса
+    activity_buffer.put(user.id, {'last_login': datetime.now(timezone.utc)})
     return {'access_token': access_token, 'refresh_token': refresh_token}
 
 
@@ -214,9 +508,39 @@ async def login(*, db: Session = Depends(get_db), user_in: schemas.UserLogin):
 )
 async def refresh_token(*, db: Session = Depends(get_db),
                         credentials: HTTPAuthorizationCredentials = Security(security)):
-    """Метод GET /refresh_token - обновить токен доступа"""
+    """
+    Метод GET /refresh_token - обновить токен доступа. Пользователь проверяется по БД,
+    новый токен содержит его текущие права.
+    """
 
-    refresh_token = credentials.credentials
-    new_token = await auth_handler.refresh_token(refresh_token)
-    await get_current_user(db=db, token=new_token)
+    user = await get_refresh_user(db=db, token=credentials.credentials)
+    new_token = await auth_handler.encode_token(user)
     return {'new_access_token': new_token}
+
+
+@app.get('/stats', tags=["service"])
+@auth_required('is_superuser')
+async def get_stats(*, db: Session = Depends(get_db),
+                    credentials: HTTPAuthorizationCredentials = Security(security)) -> Any:
+    """Метод GET /stats - получить метрики сервиса"""
+
+    return {'hashing': hasher.metrics(),
+            'principal_cache': principal_cache.stats(),
+            'token_cache': token_cache.stats(),
+            'query_cache': query_compiler.stats(),
+            'write_behind': activity_buffer.stats(),
+            'replicas': get_replicas().stats(),
+            'admission': auth_admission.stats(),
+            'batch_loader': actions.BaseActions.loader.stats()}
+
+
+@app.get('/metrics', response_class=PlainTextResponse, tags=["service"])
+async def get_metrics() -> Any:
+    """
+    Метод GET /metrics - получить метрики в текстовом формате Prometheus: время обработки
+    запросов по маршрутам, время выполнения запросов к БД, ожидание и занятость пула
+    соединений, время хэширования паролей
+    """
+
+    return PlainTextResponse(registry.render(),
+                             media_type='text/plain; version=0.0.4')
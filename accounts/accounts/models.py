@@ -10,30 +10,36 @@ VERSION
 SYNOPSIS
 ========
 
-    from accounts.models import User
+    from accounts.models import User, DeletedUser
 
 DESCRIPTION
 ===========
-Модуль содержит модель User.
+Модуль содержит модель User и модель DeletedUser - отметки об удалении пользователей,
+которые записывает триггер БД (миграция b7e3a9d41f26).
 
 MODEL
 ======
 """
 
-from datetime import datetime
+from datetime import datetime, timezone
 from uuid import uuid4
-from sqlalchemy import Column, String, DateTime, Boolean
+from sqlalchemy import Column, String, DateTime, Boolean, Index, Integer, func
 from sqlalchemy_utils import UUIDType
-from passlib.context import CryptContext
 
 from .db import Base
+from .hashing import hasher
 
 
 class User(Base):
     """Модель User"""
     
     __tablename__ = "users"
-    hasher= CryptContext(schemes=['bcrypt'])
+    __table_args__ = (
+        # Сортировка и постраничная выборка по курсору (created, id), фильтры по created.
+        # Для таблиц, в которые записи в основном добавляются, миграция 8d2b4f6a1c93
+        # может дополнительно создать BRIN-индекс ix_users_created_brin
+        Index('ix_users_created_id', 'created', 'id'),
+    )
 
     id = Column(UUIDType(binary=False),
                 primary_key=True,
@@ -46,19 +52,34 @@ class User(Base):
     is_active = Column(Boolean, default=True)
     is_verified = Column(Boolean, default=False)
     is_superuser = Column(Boolean, default=False)
-    created = Column(String, nullable=False)
-    last_login = Column(String, nullable=True)
-
-    def set_password(self, password):
-        """Установить пароль"""
-        self.password = self.hasher.hash(password)
+    created = Column(DateTime(timezone=True), nullable=False)
+    last_login = Column(DateTime(timezone=True), nullable=True)
+    # Версия выданных токенов: увеличивается при отзыве прав и (триггером БД) при
+    # изменении email, is_superuser или is_active, токены с меньшей версией отклоняются
+    # в режиме авторизации без обращения к БД и при обновлении токена
+    token_version = Column(Integer, nullable=False, default=0, server_default='0')
+    # Время последнего увеличения token_version, заполняется триггером БД; список отзыва
+    # загружает пользователей, чьи токены отозваны за время жизни access токена
+    revoked = Column(DateTime(timezone=True), nullable=True, index=True)
+
+    async def set_password(self, password):
+        """Установить пароль, хэш вычисляется в пуле хэширования"""
+        self.password = await hasher.hash(password)
+
+    def revoke_tokens(self):
+        """Отозвать ранее выданные токены пользователя"""
+        self.token_version = (self.token_version or 0) + 1
 
     def set_is_active_false(self):
-        """Установить флаг is_active в False"""
+        """Установить флаг is_active в False, отозвав токены активного пользователя"""
+        if self.is_active:
+            self.revoke_tokens()
         self.is_active = False
 
     def set_is_superuser_false(self):
-        """Установить флаг is_superuser в False"""
+        """Установить флаг is_superuser в False, отозвав токены суперпользователя"""
+        if self.is_superuser:
+            self.revoke_tokens()
         self.is_superuser = False
 
     def set_is_active_true(self):
@@ -79,8 +100,28 @@ class User(Base):
 
     def set_created(self):
         """Установить время создания записи"""
-        self.created = str(datetime.now())
+        self.created = datetime.now(timezone.utc)
 
     def set_last_login(self):
         """Установить время последнего входа пользователя"""
-        self.last_login = str(datetime.now())
+        self.last_login = datetime.now(timezone.utc)
+
+
+class DeletedUser(Base):
+    """
+    Модель DeletedUser - отметка об удалении пользователя. Запись добавляет триггер БД
+    при удалении записи users. Другой триггер увеличивает User.token_version при
+    изменении email, is_superuser или is_active.
+    """
+
+    __tablename__ = "users_deleted"
+
+    id = Column(UUIDType(binary=False), primary_key=True)
+    deleted = Column(DateTime(timezone=True), nullable=False, index=True,
+                     server_default=func.now())
+
+
+# Поиск и уникальность email без учета регистра
+Index('ix_users_email_lower', func.lower(User.email), unique=True)
+# Поиск суперпользователя в createsuperuser.py
+Index('ix_users_is_superuser', User.id, postgresql_where=User.is_superuser)
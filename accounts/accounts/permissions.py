@@ -22,6 +22,12 @@ DESCRIPTION
 ===========
 Модуль реализует декоратор @auth_required(permissions_item), который осуществляет проверку 
 значений элементов входящего запроса на соответствие заданному аргументу permissions_item.
+Сведения о пользователе, отправившем запрос, кэшируются в памяти процесса (`principal_cache`)
+на время `PRINCIPAL_CACHE_TTL`; изменение или удаление пользователя через `BaseActions`
+удаляет его запись из кэша.
+В режиме `AUTH_STATELESS` сведения о пользователе берутся из утверждений токена и
+проверяются по списку отзыва `accounts.revocation`, запрос к БД не выполняется.
+Пользователь refresh токена (`get_refresh_user`) всегда проверяется по основной БД.
 TO DO: здесь же можно реализовать детектироание ролей, роли можно передавать в токенах.
 
 MODEL
@@ -34,11 +40,15 @@ from fastapi.security import HTTPBearer
 from fastapi import Depends, FastAPI, HTTPException
 from sqlalchemy.orm import Session
 from functools import wraps
+from uuid import UUID
 
 from .auth import Auth
 from .models import User
+from .revocation import revocation_list
 
 from app.app import actions
+from app.app.cache import TTLCache
+from app.app.config import settings
 
 
 security = HTTPBearer()
@@ -53,23 +63,96 @@ permissions = {
 }
 
 
+class Principal():
+    """Сведения о пользователе, достаточные для проверки прав доступа"""
+    __slots__ = ('id', 'email', 'is_active', 'is_superuser')
+
+    def __init__(self, id, email, is_active, is_superuser):
+        self.id = id
+        self.email = email
+        self.is_active = is_active
+        self.is_superuser = is_superuser
+
+    @classmethod
+    def from_user(cls, user: User):
+        """Получить сведения о пользователе из объекта User"""
+        return cls(user.id, user.email, user.is_active, user.is_superuser)
+
+    @classmethod
+    def from_claims(cls, claims):
+        """Получить сведения о пользователе из утверждений токена"""
+        return cls(UUID(claims['user_id']), claims['username'], claims['is_active'],
+                   claims['is_superuser'])
+
+
+# Кэш сведений об авторизованных пользователях по user_id
+principal_cache = TTLCache(settings.PRINCIPAL_CACHE_SIZE, settings.PRINCIPAL_CACHE_TTL)
+
+
+def invalidate_principals(ids):
+    """Удалить из кэша сведения о пользователях с идентификаторами ids"""
+    for id in ids:
+        principal_cache.pop(str(id))
+    revocation_list.request_refresh()
+
+
+actions.BaseActions.add_change_listener(User, invalidate_principals)
+
+
 async def get_current_user(db: Session, token: str = Depends(security)):
     """Выявление наличия в базе пользователя, который отправил запрос"""
 
     request_user = await auth_handler.decode_token(token)
-    current_user = await actions.BaseActions.get_by_attr_first(User, request_user['user_id'],
-                                                               'id', db=db)
-    if not current_user:
+    if (settings.AUTH_STATELESS and revocation_list.is_fresh and
+            request_user.get('is_superuser') is not None):
+        current_user = revocation_list.check(Principal.from_claims(request_user),
+                                             request_user.get('token_version'))
+    else:
+        current_user = principal_cache.get(request_user['user_id'])
+    if current_user is None:
+        user = await actions.BaseActions.get_by_attr_first(User, request_user['user_id'],
+                                                           'id', db=db, batch=True)
+        if not user:
+            raise HTTPException(
+                status_code=HTTP_404_NOT_FOUND,
+                detail="The current user not found",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        current_user = Principal.from_user(user)
+        principal_cache.set(request_user['user_id'], current_user)
+    if not current_user.is_active:
+        raise HTTPException(
+            status_code=HTTP_400_BAD_REQUEST, detail="Inactive user"
+        )
+    return current_user
+
+
+async def get_refresh_user(db: Session, token: str):
+    """
+    Получить из основной БД пользователя, которому выдан refresh токен `token`, минуя
+    список отзыва и кэш: токен отклоняется, если пользователь удален, деактивирован или
+    его версия токенов увеличилась после выдачи токена
+    """
+
+    request_user = await auth_handler.decode_refresh_token(token)
+    user = await db.get(User, UUID(request_user['user_id']))
+    if not user:
         raise HTTPException(
             status_code=HTTP_404_NOT_FOUND,
             detail="The current user not found",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    elif not current_user.is_active:
+    if (request_user.get('token_version') or 0) < user.token_version:
+        raise HTTPException(
+            status_code=HTTP_401_UNAUTHORIZED,
+            detail="Token revoked",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if not user.is_active:
         raise HTTPException(
             status_code=HTTP_400_BAD_REQUEST, detail="Inactive user"
         )
-    return current_user
+    return user
 
 
 def auth_required(permissions_item):
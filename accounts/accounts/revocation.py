@@ -0,0 +1,170 @@
+"""
+NAME
+====
+revocation - модуль списка отзыва токенов для авторизации без обращения к БД
+
+VERSION
+=======
+0.1.0
+
+SYNOPSIS
+========
+
+    from accounts.revocation import revocation_list
+
+    await revocation_list.start(SessionLocal)
+    revocation_list.check(principal, token_version)
+
+DESCRIPTION
+===========
+В режиме `AUTH_STATELESS` права пользователя берутся из утверждений подписанного токена.
+Чтобы деактивированный или лишенный прав пользователь не пользовался токеном до
+истечения его срока, процесс держит в памяти компактный список отзыва: пользователей,
+чьи токены отозваны (колонка revoked) или которые удалены (таблица users_deleted) за
+время жизни access токена. Токены, выданные раньше, уже истекли, а новые токены
+содержат текущие права пользователя. Изменение email, is_superuser или is_active
+увеличивает версию токенов и время revoked триггером БД. Список обновляется из БД каждые
+`REVOCATION_REFRESH_INTERVAL` секунд. Если обновить список не удается дольше трех
+интервалов, он считается устаревшим, и права проверяются по БД. Более старые отметки
+об удалении удаляются при обновлении списка.
+
+MODEL
+======
+"""
+
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from typing import Dict, Optional, Set, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import delete, func, select
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED
+
+from app.app.config import TOKEN_EXP_TIME, settings
+from .models import DeletedUser, User
+
+
+logger = logging.getLogger(__name__)
+
+class RevocationList():
+    """Список отзыва токенов, периодически обновляемый из БД"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._entries: Dict[str, Tuple[int, bool, bool]] = {}
+        self._deleted: Set[str] = set()
+        self._refreshed_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def __len__(self) -> int:
+        return len(self._entries) + len(self._deleted)
+
+    @property
+    def is_fresh(self) -> bool:
+        """Список обновлялся не более трех интервалов назад"""
+        return (self._refreshed_at is not None and
+                time.monotonic() - self._refreshed_at < 3 * self.interval)
+
+    @staticmethod
+    def _since():
+        """
+        Выражение времени БД, после которого отзыв или удаление влияют на действующие
+        access токены (часы БД, а не процесса)
+        """
+        return func.now() - timedelta(minutes=TOKEN_EXP_TIME)
+
+    async def refresh(self, db):
+        """
+        Загрузить из БД пользователей, чьи токены отозваны или которые удалены за время
+        жизни access токена
+        """
+        since = self._since()
+        result = await db.execute(
+            select(User.id, User.token_version, User.is_active, User.is_superuser).filter(
+                User.revoked > since
+            )
+        )
+        entries = {str(id): (token_version, bool(is_active), bool(is_superuser))
+                   for id, token_version, is_active, is_superuser in result.all()}
+        result = await db.execute(select(DeletedUser.id).filter(DeletedUser.deleted > since))
+        self._deleted = {str(id) for id in result.scalars().all()}
+        self._entries = entries
+        self._refreshed_at = time.monotonic()
+
+    async def prune(self, db):
+        """Удалить отметки об удалении пользователей старше времени жизни access токена"""
+        await db.execute(
+            delete(DeletedUser).where(
+                DeletedUser.deleted <= self._since()
+            ).execution_options(
+                synchronize_session=False
+            )
+        )
+        await db.commit()
+
+    def check(self, principal, token_version: int):
+        """
+        Проверить сведения о пользователе `principal`, полученные из токена с версией
+        `token_version`, по списку отзыва. Токены удаленных пользователей отклоняются.
+        """
+        id = str(principal.id)
+        entry = self._entries.get(id)
+        if entry is None and id not in self._deleted:
+            return principal
+        current_version, is_active, is_superuser = entry or (None, False, False)
+        if current_version is None or (token_version or 0) < current_version:
+            raise HTTPException(
+                status_code=HTTP_401_UNAUTHORIZED,
+                detail="Token revoked",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        if not is_active:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Inactive user")
+        principal.is_superuser = principal.is_superuser and is_superuser
+        return principal
+
+    def request_refresh(self):
+        """Обновить список отзыва, не дожидаясь окончания интервала"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self, session_factory):
+        """Периодическое обновление списка отзыва"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                async with session_factory() as db:
+                    await self.refresh(db)
+                    await self.prune(db)
+            except Exception:
+                # Список остается прежним, при устаревании права проверяются по БД
+                logger.warning('Revocation list refresh failed', exc_info=True)
+
+    async def start(self, session_factory):
+        """Загрузить список отзыва и запустить его периодическое обновление"""
+        async with session_factory() as db:
+            await self.refresh(db)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(session_factory))
+
+    async def stop(self):
+        """Остановить периодическое обновление списка отзыва"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+
+
+# Экземпляр списка отзыва для использования в permissions
+revocation_list = RevocationList(settings.REVOCATION_REFRESH_INTERVAL)
@@ -27,8 +27,9 @@ MODEL
 ======
 """
 
-from typing import Optional
-from pydantic import BaseModel, UUID4
+from datetime import datetime
+from typing import List, Optional
+from pydantic import BaseModel, UUID4, validator
 
 
 class UserBase(BaseModel):
@@ -39,8 +40,8 @@ class UserBase(BaseModel):
     is_active: bool = True
     is_verified: Optional[bool] = False
     is_superuser: Optional[bool] = False
-    created: Optional[str]
-    last_login: Optional[str]
+    created: Optional[datetime]
+    last_login: Optional[datetime]
 
     class Config:
         orm_mode = True
@@ -52,8 +53,8 @@ class UserBase(BaseModel):
                 "is_active": True,
                 "is_verified": False,
                 "is_superuser": False,
-                "created": "2022-05-21 18:26:01.602931",
-                "last_login": "2022-05-21 18:26:01.602931"
+                "created": "2022-05-21T18:26:01.602931+00:00",
+                "last_login": "2022-05-21T18:26:01.602931+00:00"
             }
         }
 
@@ -92,12 +93,68 @@ class UserCreating(BaseModel):
         }
 
 
+class UsersBulkCreating(BaseModel):
+    """Схема входных данных для метода массового создания объектов User"""
+    users: List[UserCreating]
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "users": [
+                    {
+                        "email": "test@test.com",
+                        "first_name": "John",
+                        "last_name": "Brown",
+                        "password": "password"
+                    }
+                ]
+            }
+        }
+
+
+class UsersBulkDeleting(BaseModel):
+    """Схема входных данных для метода массового удаления объектов User"""
+    ids: List[UUID4]
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "ids": ["689f4bd2-d4b5-45c4-889b-76e0926c2001"]
+            }
+        }
+
+
+class BulkItemError(BaseModel):
+    """Схема ошибки обработки элемента массовой операции"""
+    index: int
+    detail: str
+
+
+class UsersBulkCreated(BaseModel):
+    """Схема выдачи метода массового создания объектов User"""
+    created: List[UserCreated]
+    errors: List[BulkItemError]
+
+
+class UsersBulkDeleted(BaseModel):
+    """Схема выдачи метода массового удаления объектов User"""
+    deleted: List[UUID4]
+    errors: List[BulkItemError]
+
+
 class UserUpdate(BaseModel):
     """Схема входных данных для метода обновления объекта User"""
     email: Optional[str]
     first_name: Optional[str]
     last_name: Optional[str]
 
+    @validator('email')
+    def email_not_null(cls, value):
+        """Поле email можно не передавать, но нельзя очистить"""
+        if value is None:
+            raise ValueError('email may not be null')
+        return value
+
     class Config:
         orm_mode = True
         schema_extra = {
@@ -123,8 +180,8 @@ class UserInDBBase(UserBase):
                 "is_active": True,
                 "is_verified": False,
                 "is_superuser": False,
-                "created": "2022-05-21 18:26:01.602931",
-                "last_login": "2022-05-21 18:26:01.602931",
+                "created": "2022-05-21T18:26:01.602931+00:00",
+                "last_login": "2022-05-21T18:26:01.602931+00:00",
                 "id": "689f4bd2-d4b5-45c4-889b-76e0926c2001",
             }
         }
@@ -0,0 +1,36 @@
+"""Users email lower index
+
+Revision ID: 3c1f5e9a7b42
+Revises: ee77fd22ff02
+Create Date: 2026-10-18 12:20:31.507218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f5e9a7b42'
+down_revision = 'ee77fd22ff02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Индексы строятся без блокировки записи в таблицу. Если в таблице есть email,
+    # различающиеся только регистром, создание уникального индекса завершится ошибкой:
+    # такие записи нужно объединить до применения миграции.
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_email_lower', 'users', [sa.text('lower(email)')],
+                        unique=True, postgresql_concurrently=True)
+        op.create_index('ix_users_is_superuser', 'users', ['id'], unique=False,
+                        postgresql_where=sa.text('is_superuser'),
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_users_is_superuser', table_name='users',
+                      postgresql_concurrently=True)
+        op.drop_index('ix_users_email_lower', table_name='users',
+                      postgresql_concurrently=True)
@@ -0,0 +1,30 @@
+"""Users created id index
+
+Revision ID: 66a6d0b8eba5
+Revises: 9e597cf2ace1
+Create Date: 2026-10-18 10:50:12.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '66a6d0b8eba5'
+down_revision = '9e597cf2ace1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Индекс для постраничной выборки GET /users по курсору (created, id). Строится без
+    # блокировки записи в таблицу, что невозможно внутри транзакции
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_created_id', 'users', ['created', 'id'], unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_users_created_id', table_name='users',
+                      postgresql_concurrently=True)
@@ -0,0 +1,107 @@
+"""Users created and last_login timestamptz
+
+Revision ID: 8d2b4f6a1c93
+Revises: 3c1f5e9a7b42
+Create Date: 2026-10-18 14:02:47.183406
+
+Колонки created и last_login переводятся из строк в timestamptz без длительной
+блокировки таблицы:
+
+    1. добавляются колонки created_tz и last_login_tz, триггер заполняет их при
+       вставке и изменении записей на время миграции;
+    2. существующие записи заполняются порциями по id, каждая порция фиксируется
+       отдельной транзакцией;
+    3. индексы строятся без блокировки записи, NOT NULL проверяется ограничением
+       NOT VALID + VALIDATE;
+    4. в короткой транзакции старые колонки удаляются, новые переименовываются.
+
+Строки времени приводятся к timestamptz в часовом поясе сессии (параметр TimeZone
+сервера). Параметры миграции:
+
+    alembic -x batch_size=10000 -x brin=true upgrade head
+
+batch_size - число записей в порции (по умолчанию 10000), brin=true - дополнительно
+создать BRIN-индекс ix_users_created_brin по created для таблиц, в которые записи в
+основном добавляются. Приложение, записывающее строки в created и last_login, нужно
+обновить сразу после миграции.
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2b4f6a1c93'
+down_revision = '3c1f5e9a7b42'
+branch_labels = None
+depends_on = None
+
+
+BACKFILL = sa.text(
+    'WITH batch AS ('
+    '    SELECT id FROM users WHERE id > :last_id ORDER BY id LIMIT :batch_size'
+    '), updated AS ('
+    '    UPDATE users SET created_tz = users.created::timestamptz,'
+    "        last_login_tz = NULLIF(users.last_login, '')::timestamptz"
+    '    FROM batch WHERE users.id = batch.id'
+    ') '
+    'SELECT id FROM batch ORDER BY id DESC LIMIT 1'
+)
+
+
+def upgrade():
+    options = context.get_x_argument(as_dictionary=True)
+    batch_size = int(options.get('batch_size', 10000))
+
+    op.add_column('users', sa.Column('created_tz', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('users', sa.Column('last_login_tz', sa.DateTime(timezone=True),
+                                     nullable=True))
+    op.execute(
+        'CREATE FUNCTION users_sync_timestamptz() RETURNS trigger AS $$ '
+        'BEGIN '
+        '    NEW.created_tz := NEW.created::timestamptz; '
+        "    NEW.last_login_tz := NULLIF(NEW.last_login, '')::timestamptz; "
+        '    RETURN NEW; '
+        'END $$ LANGUAGE plpgsql'
+    )
+    op.execute(
+        'CREATE TRIGGER users_sync_timestamptz '
+        'BEFORE INSERT OR UPDATE OF created, last_login ON users '
+        'FOR EACH ROW EXECUTE FUNCTION users_sync_timestamptz()'
+    )
+
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        last_id = '00000000-0000-0000-0000-000000000000'
+        while True:
+            last_id = bind.execute(BACKFILL, {'last_id': last_id,
+                                              'batch_size': batch_size}).scalar()
+            if last_id is None:
+                break
+        op.create_index('ix_users_created_tz_id', 'users', ['created_tz', 'id'],
+                        unique=False, postgresql_concurrently=True)
+        if options.get('brin', '').lower() in ('true', '1', 'yes'):
+            op.create_index('ix_users_created_brin', 'users', ['created_tz'], unique=False,
+                            postgresql_using='brin', postgresql_concurrently=True)
+        op.execute('ALTER TABLE users ADD CONSTRAINT users_created_tz_not_null '
+                   'CHECK (created_tz IS NOT NULL) NOT VALID')
+        op.execute('ALTER TABLE users VALIDATE CONSTRAINT users_created_tz_not_null')
+
+    # Проверенное ограничение позволяет установить NOT NULL без просмотра таблицы
+    op.execute("SET LOCAL lock_timeout = '5s'")
+    op.execute('DROP TRIGGER users_sync_timestamptz ON users')
+    op.execute('DROP FUNCTION users_sync_timestamptz()')
+    op.drop_index('ix_users_created_id', table_name='users')
+    op.drop_column('users', 'created')
+    op.drop_column('users', 'last_login')
+    op.alter_column('users', 'created_tz', new_column_name='created', nullable=False)
+    op.alter_column('users', 'last_login_tz', new_column_name='last_login')
+    op.drop_constraint('users_created_tz_not_null', 'users', type_='check')
+    op.execute('ALTER INDEX ix_users_created_tz_id RENAME TO ix_users_created_id')
+
+
+def downgrade():
+    op.execute('DROP INDEX IF EXISTS ix_users_created_brin')
+    op.alter_column('users', 'created', type_=sa.String(), existing_nullable=False,
+                    postgresql_using="to_char(created, 'YYYY-MM-DD HH24:MI:SS.US')")
+    op.alter_column('users', 'last_login', type_=sa.String(), existing_nullable=True,
+                    postgresql_using="to_char(last_login, 'YYYY-MM-DD HH24:MI:SS.US')")
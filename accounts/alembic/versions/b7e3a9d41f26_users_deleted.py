@@ -0,0 +1,69 @@
+"""Users deleted and token version triggers
+
+Revision ID: b7e3a9d41f26
+Revises: 8d2b4f6a1c93
+Create Date: 2026-10-18 16:21:05.402117
+
+Удаление пользователя записывается в таблицу users_deleted, а изменение email,
+is_superuser или is_active увеличивает token_version. Триггеры срабатывают при любом
+способе изменения записей (ORM, UPDATE ... RETURNING, пакетные запросы), поэтому
+список отзыва `accounts.revocation` видит все такие изменения.
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3a9d41f26'
+down_revision = '8d2b4f6a1c93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'users_deleted',
+        sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('deleted', sa.DateTime(timezone=True), nullable=False,
+                  server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_users_deleted_deleted', 'users_deleted', ['deleted'], unique=False)
+    op.execute(
+        'CREATE FUNCTION users_record_deleted() RETURNS trigger AS $$ '
+        'BEGIN '
+        '    INSERT INTO users_deleted (id) VALUES (OLD.id) '
+        '    ON CONFLICT (id) DO UPDATE SET deleted = now(); '
+        '    RETURN OLD; '
+        'END $$ LANGUAGE plpgsql'
+    )
+    op.execute(
+        'CREATE TRIGGER users_record_deleted AFTER DELETE ON users '
+        'FOR EACH ROW EXECUTE FUNCTION users_record_deleted()'
+    )
+    op.execute(
+        'CREATE FUNCTION users_bump_token_version() RETURNS trigger AS $$ '
+        'BEGIN '
+        '    IF NEW.email IS DISTINCT FROM OLD.email '
+        '            OR NEW.is_superuser IS DISTINCT FROM OLD.is_superuser '
+        '            OR NEW.is_active IS DISTINCT FROM OLD.is_active THEN '
+        '        NEW.token_version := GREATEST(NEW.token_version, OLD.token_version + 1); '
+        '    END IF; '
+        '    RETURN NEW; '
+        'END $$ LANGUAGE plpgsql'
+    )
+    op.execute(
+        'CREATE TRIGGER users_bump_token_version '
+        'BEFORE UPDATE OF email, is_superuser, is_active ON users '
+        'FOR EACH ROW EXECUTE FUNCTION users_bump_token_version()'
+    )
+
+
+def downgrade():
+    op.execute('DROP TRIGGER users_bump_token_version ON users')
+    op.execute('DROP FUNCTION users_bump_token_version()')
+    op.execute('DROP TRIGGER users_record_deleted ON users')
+    op.execute('DROP FUNCTION users_record_deleted()')
+    op.drop_index('ix_users_deleted_deleted', table_name='users_deleted')
+    op.drop_table('users_deleted')
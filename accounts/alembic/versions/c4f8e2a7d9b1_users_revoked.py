@@ -0,0 +1,68 @@
+"""Users revoked
+
+Revision ID: c4f8e2a7d9b1
+Revises: b7e3a9d41f26
+Create Date: 2026-10-18 18:07:31.550924
+
+Колонка revoked - время последнего увеличения token_version. Ее заполняет триггер
+users_bump_token_version, теперь срабатывающий и при прямом изменении token_version.
+Список отзыва `accounts.revocation` загружает по индексу только пользователей, чьи
+токены отозваны за время жизни access токена.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4f8e2a7d9b1'
+down_revision = 'b7e3a9d41f26'
+branch_labels = None
+depends_on = None
+
+
+BUMP_TOKEN_VERSION = (
+    'CREATE OR REPLACE FUNCTION users_bump_token_version() RETURNS trigger AS $$ '
+    'BEGIN '
+    '    IF NEW.email IS DISTINCT FROM OLD.email '
+    '            OR NEW.is_superuser IS DISTINCT FROM OLD.is_superuser '
+    '            OR NEW.is_active IS DISTINCT FROM OLD.is_active THEN '
+    '        NEW.token_version := GREATEST(NEW.token_version, OLD.token_version + 1); '
+    '    END IF; '
+    '{revoked}'
+    '    RETURN NEW; '
+    'END $$ LANGUAGE plpgsql'
+)
+
+
+def upgrade():
+    op.add_column('users', sa.Column('revoked', sa.DateTime(timezone=True), nullable=True))
+    op.execute(BUMP_TOKEN_VERSION.format(revoked=(
+        '    IF NEW.token_version > OLD.token_version THEN '
+        '        NEW.revoked := now(); '
+        '    END IF; '
+    )))
+    op.execute('DROP TRIGGER users_bump_token_version ON users')
+    op.execute(
+        'CREATE TRIGGER users_bump_token_version '
+        'BEFORE UPDATE OF email, is_superuser, is_active, token_version ON users '
+        'FOR EACH ROW EXECUTE FUNCTION users_bump_token_version()'
+    )
+    # Токены, отозванные до миграции, могут еще действовать: они попадают в список отзыва
+    # на время жизни access токена
+    op.execute('UPDATE users SET revoked = now() WHERE token_version > 0 OR NOT is_active')
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_revoked', 'users', ['revoked'], unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_users_revoked', table_name='users', postgresql_concurrently=True)
+    op.execute('DROP TRIGGER users_bump_token_version ON users')
+    op.execute(
+        'CREATE TRIGGER users_bump_token_version '
+        'BEFORE UPDATE OF email, is_superuser, is_active ON users '
+        'FOR EACH ROW EXECUTE FUNCTION users_bump_token_version()'
+    )
+    op.execute(BUMP_TOKEN_VERSION.format(revoked=''))
+    op.drop_column('users', 'revoked')
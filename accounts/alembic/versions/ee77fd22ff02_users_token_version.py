@@ -0,0 +1,26 @@
+"""Users token version
+
+Revision ID: ee77fd22ff02
+Revises: 66a6d0b8eba5
+Create Date: 2026-10-18 11:02:40.913724
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ee77fd22ff02'
+down_revision = '66a6d0b8eba5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Колонка с постоянным значением по умолчанию добавляется без перезаписи таблицы
+    op.add_column('users', sa.Column('token_version', sa.Integer(), nullable=False,
+                                     server_default='0'))
+
+
+def downgrade():
+    op.drop_column('users', 'token_version')
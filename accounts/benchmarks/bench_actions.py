@@ -0,0 +1,348 @@
+"""
+NAME
+====
+bench_actions - нагрузочный тест методов BaseActions на таблице users
+
+VERSION
+=======
+0.1.0
+
+SYNOPSIS
+========
+
+    python -m benchmarks.bench_actions --sizes 10k,1m --update-baseline
+    python -m benchmarks.bench_actions --sizes 10k,1m
+
+DESCRIPTION
+===========
+Скрипт запускает собственный экземпляр PostgreSQL во временном каталоге (initdb и
+pg_ctl из `--pg-bin`, переменной окружения `PG_BIN` или `PATH`), создает таблицу users,
+заполняет ее до 10k, 1M и 10M записей и для каждого размера измеряет методы
+BaseActions: get_all, get_all_by_cursor, get_by_attr_first (по id и по email),
+get_by_attr_lower_first, get_by_attr_all, create, update и remove. Для каждого метода
+выводятся перцентили задержки p50, p95 и p99 в миллисекундах и число SQL-запросов на
+вызов.
+
+С ключом `--update-baseline` результаты сохраняются в файл `--baseline` (по умолчанию
+benchmarks/baseline.json). Без него результаты сравниваются с сохраненными: если p95
+вырос больше чем на `--tolerance` или вырос число запросов, скрипт завершается с кодом 1.
+Базовые значения имеют смысл только для той машины, на которой они получены.
+
+Вместо запуска собственного сервера можно передать `--dsn` существующей пустой БД.
+PostgreSQL не запускается от имени root, поэтому без `--dsn` скрипт запускается от
+имени обычного пользователя. Скрипт запускается из каталога accounts.
+
+MODEL
+======
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+
+# Размеры таблицы users, для которых выполняются измерения
+SIZES = {'10k': 10_000, '1m': 1_000_000, '10m': 10_000_000}
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+class PostgresServer():
+    """Временный экземпляр PostgreSQL, запускаемый на время измерений"""
+
+    def __init__(self, pg_bin: Optional[str] = None):
+        self.pg_bin = pg_bin or os.environ.get('PG_BIN') or self._find_bin()
+        self.data_dir = tempfile.mkdtemp(prefix='bench_pg_')
+        self.port = self._free_port()
+
+    @staticmethod
+    def _find_bin() -> str:
+        """Каталог с initdb и pg_ctl: из PATH или по pg_config --bindir"""
+        initdb = shutil.which('initdb')
+        if initdb:
+            return os.path.dirname(initdb)
+        pg_config = shutil.which('pg_config')
+        if pg_config:
+            return subprocess.check_output([pg_config, '--bindir'], text=True).strip()
+        raise RuntimeError('PostgreSQL binaries not found, use --pg-bin or PG_BIN')
+
+    @staticmethod
+    def _free_port() -> int:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    @property
+    def dsn(self) -> str:
+        return f'postgresql+asyncpg://postgres@127.0.0.1:{self.port}/postgres'
+
+    def start(self):
+        """Инициализировать кластер и запустить сервер"""
+        subprocess.run(
+            [os.path.join(self.pg_bin, 'initdb'), '-D', self.data_dir, '-U', 'postgres',
+             '-A', 'trust', '--no-sync'],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        # Сервер одноразовый, поэтому надежность записи не нужна
+        options = (f'-p {self.port} -k {self.data_dir} -c listen_addresses=127.0.0.1 '
+                   '-c fsync=off -c synchronous_commit=off -c full_page_writes=off')
+        subprocess.run(
+            [os.path.join(self.pg_bin, 'pg_ctl'), '-D', self.data_dir, '-o', options,
+             '-l', os.path.join(self.data_dir, 'server.log'), '-w', 'start'],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+
+    def stop(self):
+        """Остановить сервер и удалить каталог кластера"""
+        subprocess.run(
+            [os.path.join(self.pg_bin, 'pg_ctl'), '-D', self.data_dir, '-m', 'fast', '-w',
+             'stop'],
+            stdout=subprocess.DEVNULL,
+        )
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """Перцентили p50, p95, p99 и среднее по выборке задержек в миллисекундах"""
+    quantiles = statistics.quantiles(samples, n=100, method='inclusive')
+    return {
+        'p50': round(quantiles[49], 3),
+        'p95': round(quantiles[94], 3),
+        'p99': round(quantiles[98], 3),
+        'mean': round(statistics.fmean(samples), 3),
+    }
+
+
+class Bench():
+    """Измерение методов BaseActions на таблице users заданного размера"""
+
+    def __init__(self, iterations: int):
+        # Модули accounts читают параметры подключения при импорте, поэтому
+        # импортируются после того, как известен адрес сервера
+        from sqlalchemy import event
+        from accounts.db import Base, SessionLocal, engine
+        from accounts.main import user_actions
+        from accounts.models import User
+
+        self.iterations = iterations
+        self.engine = engine
+        self.SessionLocal = SessionLocal
+        self.Base = Base
+        self.User = User
+        self.actions = user_actions
+        self.queries = 0
+
+        @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+        def count_query(*args):
+            self.queries += 1
+
+    async def create_schema(self):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(self.Base.metadata.drop_all)
+            await conn.run_sync(self.Base.metadata.create_all)
+
+    async def seed(self, size: int):
+        """Дополнить таблицу users до `size` записей и обновить статистику"""
+        async with self.engine.begin() as conn:
+            current = (await conn.exec_driver_sql('SELECT count(*) FROM users')).scalar()
+            if current < size:
+                await conn.exec_driver_sql(
+                    "INSERT INTO users (id, email, password, first_name, last_name, "
+                    "is_active, is_verified, is_superuser, created, token_version) "
+                    "SELECT gen_random_uuid(), 'user' || i || '@bench.local', 'x', "
+                    "'name' || mod(i, 1000), 'last' || i, true, false, false, "
+                    "timestamptz '2020-01-01 00:00:00+00' + i * interval '1 second', 0 "
+                    f"FROM generate_series({current + 1}, {size}) AS i"
+                )
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+            await conn.exec_driver_sql('VACUUM ANALYZE users')
+
+    async def sample(self, count: int) -> List[Any]:
+        """Случайные существующие записи (id, email) для точечных выборок"""
+        async with self.engine.connect() as conn:
+            result = await conn.exec_driver_sql(
+                f'SELECT id, email FROM users ORDER BY random() LIMIT {count}'
+            )
+            return result.all()
+
+    async def measure(self, operation, prepare=None) -> Dict[str, float]:
+        """
+        Выполнить `operation(db, i)` `iterations` раз, каждый раз в новой сессии, как
+        при обработке запроса. `prepare(db, i)` выполняется перед измерением, его
+        результат передается в `operation`, а запросы не учитываются.
+        """
+        samples = []
+        queries = []
+        for i in range(self.iterations):
+            async with self.SessionLocal() as db:
+                arg = await prepare(db, i) if prepare else None
+                self.queries = 0
+                start = time.perf_counter()
+                await operation(db, i, arg)
+                await db.commit()
+                samples.append((time.perf_counter() - start) * 1000)
+                queries.append(self.queries)
+        return {**percentiles(samples), 'queries': max(queries)}
+
+    async def run(self, size: int) -> Dict[str, Dict[str, float]]:
+        """Измерить методы BaseActions на таблице из `size` записей"""
+        User = self.User
+        actions = self.actions
+        await self.seed(size)
+        rows = await self.sample(self.iterations)
+        rows = [rows[i % len(rows)] for i in range(self.iterations)]
+        created = []
+        prefix = f'{size}-{time.time_ns()}'
+
+        async def get_all(db, i, arg):
+            await actions.get_all(User, 'created', db, skip=0, limit=100)
+
+        async def get_all_by_cursor(db, i, arg):
+            await actions.get_all_by_cursor(User, 'created', db, cursor=None, limit=100)
+
+        async def get_by_id(db, i, arg):
+            await actions.get_by_attr_first(User, rows[i][0], 'id', db)
+
+        async def get_by_email(db, i, arg):
+            await actions.get_by_attr_first(User, rows[i][1], 'email', db)
+
+        async def get_by_email_lower(db, i, arg):
+            await actions.get_by_attr_lower_first(User, rows[i][1], 'email', db)
+
+        async def get_by_attr_all(db, i, arg):
+            await actions.get_by_attr_all(User, f'name{i % 1000}', 'first_name', db)
+
+        async def create(db, i, arg):
+            user = User(email=f'bench-{prefix}-{i}@bench.local', password='x')
+            user.set_created()
+            created.append((await actions.create(db, db_obj=user)).id)
+
+        async def get_created(db, i):
+            return await actions.get_by_attr_first(User, created[i], 'id', db)
+
+        async def update(db, i, user):
+            await actions.update(db, db_obj=user, obj_in={'first_name': f'updated{i}'})
+
+        async def remove(db, i, user):
+            await actions.remove(user, db=db)
+
+        return {
+            'get_all': await self.measure(get_all),
+            'get_all_by_cursor': await self.measure(get_all_by_cursor),
+            'get_by_attr_first_id': await self.measure(get_by_id),
+            'get_by_attr_first_email': await self.measure(get_by_email),
+            'get_by_attr_lower_first_email': await self.measure(get_by_email_lower),
+            'get_by_attr_all': await self.measure(get_by_attr_all),
+            'create': await self.measure(create),
+            'update': await self.measure(update, get_created),
+            'remove': await self.measure(remove, get_created),
+        }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any],
+            tolerance: float) -> List[str]:
+    """Список регрессий результатов `results` относительно базовых `baseline`"""
+    regressions = []
+    for size, operations in results.items():
+        for operation, current in operations.items():
+            base = baseline.get(size, {}).get(operation)
+            if base is None:
+                continue
+            if current['p95'] > base['p95'] * (1 + tolerance):
+                regressions.append(f"{size} {operation}: p95 {base['p95']} -> "
+                                   f"{current['p95']} ms")
+            if current['queries'] > base['queries']:
+                regressions.append(f"{size} {operation}: queries {base['queries']} -> "
+                                   f"{current['queries']}")
+    return regressions
+
+
+def print_results(size: str, operations: Dict[str, Dict[str, float]]):
+    print(f'\nusers: {size}')
+    print(f"{'operation':<32}{'p50':>10}{'p95':>10}{'p99':>10}{'queries':>9}")
+    for operation, values in operations.items():
+        print(f"{operation:<32}{values['p50']:>10.3f}{values['p95']:>10.3f}"
+              f"{values['p99']:>10.3f}{values['queries']:>9}")
+
+
+async def main(args) -> int:
+    bench = Bench(args.iterations)
+    results = {}
+    try:
+        await bench.create_schema()
+        for size in sorted(args.sizes, key=SIZES.get):
+            results[size] = await bench.run(SIZES[size])
+            print_results(size, results[size])
+    finally:
+        await bench.engine.dispose()
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({
+                'meta': {
+                    'iterations': args.iterations,
+                    'python': platform.python_version(),
+                    'machine': platform.platform(),
+                },
+                'results': results,
+            }, f, indent=2)
+        print(f'\nBaseline saved to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'\nNo baseline at {args.baseline}, run with --update-baseline')
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--sizes', default='10k',
+                        type=lambda value: [size.strip().lower() for size in value.split(',')],
+                        help='table sizes: 10k, 1m, 10m (comma separated)')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative p95 growth')
+    parser.add_argument('--pg-bin', help='directory with initdb and pg_ctl')
+    parser.add_argument('--dsn', help='use an existing empty database instead')
+    args = parser.parse_args(argv)
+    unknown = set(args.sizes) - set(SIZES)
+    if unknown:
+        parser.error(f'unknown sizes: {", ".join(sorted(unknown))}')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = None
+    if args.dsn is None:
+        server = PostgresServer(args.pg_bin)
+        server.start()
+        args.dsn = server.dsn
+    os.environ['SQLALCHEMY_DATABASE_URI'] = args.dsn
+    for name in ('POSTGRES_SERVER', 'POSTGRES_USER', 'POSTGRES_PASSWORD', 'POSTGRES_DB',
+                 'AUTH_SECRET_STRING'):
+        os.environ.setdefault(name, 'bench')
+    try:
+        code = asyncio.run(main(args))
+    finally:
+        if server is not None:
+            server.stop()
+    sys.exit(code)
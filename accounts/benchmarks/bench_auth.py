@@ -0,0 +1,73 @@
+"""
+NAME
+====
+bench_auth - микротест стоимости проверки access токена
+
+VERSION
+=======
+0.1.0
+
+SYNOPSIS
+========
+
+    python -m benchmarks.bench_auth --iterations 100000
+
+DESCRIPTION
+===========
+Скрипт измеряет среднее время вызова `Auth.decode_token` в микросекундах для одного и
+того же токена: без кэша (кэш очищается перед каждым вызовом, подпись проверяется
+каждый раз, как до появления кэша) и с кэшем (подпись проверена при первом вызове).
+БД не требуется. Скрипт запускается из каталога accounts.
+
+MODEL
+======
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+
+async def measure(decode, token, iterations: int, before=None) -> float:
+    """Среднее время вызова `decode(token)` в микросекундах"""
+    elapsed = 0.0
+    for _ in range(iterations):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        await decode(token)
+        elapsed += time.perf_counter() - start
+    return elapsed / iterations * 1_000_000
+
+
+async def main(iterations: int):
+    from accounts.auth import Auth, token_cache
+    from accounts.models import User
+
+    auth = Auth()
+    user = User(email='bench@bench.local', is_active=True, is_superuser=False,
+                token_version=0)
+    token = await auth.encode_token(user)
+
+    uncached = await measure(auth.decode_token, token, iterations, before=token_cache.clear)
+    token_cache.clear()
+    token_cache.hits = token_cache.misses = 0
+    cached = await measure(auth.decode_token, token, iterations)
+
+    print(f"{'decode_token':<24}{'us/call':>10}")
+    print(f"{'uncached':<24}{uncached:>10.2f}")
+    print(f"{'cached':<24}{cached:>10.2f}")
+    print(f'speedup: {uncached / cached:.1f}x, cache hit rate: '
+          f"{token_cache.stats()['hit_rate']:.4f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Auth.decode_token micro-benchmark')
+    parser.add_argument('--iterations', type=int, default=100_000)
+    args = parser.parse_args()
+    # Модули accounts требуют параметров подключения к БД, хотя БД не используется
+    for name in ('POSTGRES_SERVER', 'POSTGRES_USER', 'POSTGRES_PASSWORD', 'POSTGRES_DB',
+                 'AUTH_SECRET_STRING'):
+        os.environ.setdefault(name, 'bench')
+    asyncio.run(main(args.iterations))
@@ -0,0 +1,96 @@
+"""
+NAME
+====
+bench_json - микротест сериализации списка пользователей в ответе GET /users
+
+VERSION
+=======
+0.1.0
+
+SYNOPSIS
+========
+
+    python -m benchmarks.bench_json --sizes 100,1000
+
+DESCRIPTION
+===========
+Скрипт измеряет пропускную способность (ответов в секунду) формирования тела ответа
+со списком из 100 и 1000 объектов User:
+
+    pydantic - прежний путь FastAPI: валидация List[schemas.User] в orm_mode,
+               jsonable_encoder и стандартный модуль json;
+    fast/json - заранее построенный сериализатор и FastJSONResponse на модуле json;
+    fast/orjson - заранее построенный сериализатор и FastJSONResponse на orjson.
+
+Объекты создаются в памяти, БД не требуется. Скрипт запускается из каталога accounts.
+
+MODEL
+======
+"""
+
+import argparse
+import asyncio
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import List
+
+
+async def throughput(render, seconds: float) -> float:
+    """Число вызовов `render()` в секунду за `seconds` секунд"""
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        await render()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+async def main(sizes: List[int], seconds: float):
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_response_field
+
+    from accounts import schemas
+    from accounts.main import serialize_user
+    from accounts.models import User
+    from app.app import serialization
+    from app.app.config import settings
+
+    field = create_response_field(name='Response_list_users', type_=List[schemas.User])
+    print(f"{'users':>6}{'pydantic':>12}{'fast/json':>12}{'fast/orjson':>13}  responses/s")
+    for size in sizes:
+        users = [User(id=uuid.uuid4(), email=f'user{i}@bench.local', first_name='John',
+                      last_name=None, is_active=True, is_verified=False,
+                      is_superuser=False, created=datetime.now(timezone.utc), last_login=None)
+                 for i in range(size)]
+
+        async def pydantic_path():
+            content = await serialize_response(field=field, response_content=users)
+            JSONResponse(content).body
+
+        async def fast_path():
+            serialization.FastJSONResponse([serialize_user(user) for user in users]).body
+
+        results = [await throughput(pydantic_path, seconds)]
+        for encoder in ('json', 'orjson'):
+            settings.JSON_ENCODER = encoder
+            if encoder == 'orjson' and serialization.orjson is None:
+                results.append(float('nan'))
+                continue
+            results.append(await throughput(fast_path, seconds))
+        print(f'{size:>6}{results[0]:>12.1f}{results[1]:>12.1f}{results[2]:>13.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='GET /users serialization micro-benchmark')
+    parser.add_argument('--sizes', default='100,1000',
+                        type=lambda value: [int(size) for size in value.split(',')])
+    parser.add_argument('--seconds', type=float, default=2.0)
+    args = parser.parse_args()
+    # Модули accounts требуют параметров подключения к БД, хотя БД не используется
+    for name in ('POSTGRES_SERVER', 'POSTGRES_USER', 'POSTGRES_PASSWORD', 'POSTGRES_DB',
+                 'AUTH_SECRET_STRING'):
+        os.environ.setdefault(name, 'bench')
+    asyncio.run(main(args.sizes, args.seconds))
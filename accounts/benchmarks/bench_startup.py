@@ -0,0 +1,132 @@
+"""
+NAME
+====
+bench_startup - тест времени импорта и запуска приложения accounts.main:app
+
+VERSION
+=======
+0.1.0
+
+SYNOPSIS
+========
+
+    python -m benchmarks.bench_startup --runs 5
+
+DESCRIPTION
+===========
+Скрипт измеряет медианы по `--runs` запускам в отдельных процессах:
+
+    import - время импорта `accounts.main`;
+    ready - время от запуска процесса uvicorn до первого ответа GET /metrics, т.е. до
+            завершения обработчиков startup;
+    first - время первого запроса к БД (POST /login с несуществующим email);
+    second - время того же запроса повторно.
+
+Запуск приложения измеряется без прогрева (`DB_POOL_WARMUP=0`) и с прогревом
+(`DB_POOL_WARMUP` из окружения или по умолчанию). Параметры подключения к БД берутся
+из окружения, как в приложении. Скрипт запускается из каталога accounts.
+
+MODEL
+======
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional
+
+
+IMPORT_SCRIPT = ('import time; start = time.perf_counter(); import accounts.main; '
+                 'print(time.perf_counter() - start)')
+
+
+def free_port() -> int:
+    """Свободный TCP-порт"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def request(url: str, body: Optional[dict] = None) -> int:
+    """Выполнить запрос и вернуть статус ответа"""
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=30) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def timed(url: str, body: Optional[dict] = None) -> float:
+    """Время запроса в миллисекундах"""
+    start = time.perf_counter()
+    request(url, body)
+    return (time.perf_counter() - start) * 1000
+
+
+def measure_import() -> float:
+    """Время импорта accounts.main в миллисекундах"""
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT])
+    return float(output) * 1000
+
+
+def measure_startup(env: Dict[str, str], timeout: float = 60) -> Dict[str, float]:
+    """Время до готовности приложения и первого и второго запроса к БД в миллисекундах"""
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'accounts.main:app', '--port', str(port),
+         '--log-level', 'warning'],
+        env=env,
+    )
+    try:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError('uvicorn exited before startup completed')
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError('uvicorn did not start in time')
+            try:
+                if request(f'{url}/metrics') == 200:
+                    break
+            except OSError:
+                pass
+            # Пауза и при ответе не 200, чтобы не нагружать запускаемое приложение
+            time.sleep(0.005)
+        ready = (time.perf_counter() - start) * 1000
+        body = {'email': f'bench-{port}@bench.local', 'password': 'password'}
+        first = timed(f'{url}/login', body)
+        second = timed(f'{url}/login', body)
+    finally:
+        process.terminate()
+        process.wait()
+    return {'ready': ready, 'first': first, 'second': second}
+
+
+def main(runs: int):
+    imports = [measure_import() for _ in range(runs)]
+    print(f"{'import accounts.main':<24}{statistics.median(imports):>10.1f} ms")
+    print(f"{'DB_POOL_WARMUP':<24}{'ready':>10}{'first':>10}{'second':>10}  ms")
+    for warmup in ('0', os.environ.get('DB_POOL_WARMUP', 'default')):
+        env = dict(os.environ)
+        if warmup != 'default':
+            env['DB_POOL_WARMUP'] = warmup
+        results: List[Dict[str, float]] = [measure_startup(env) for _ in range(runs)]
+        medians = [statistics.median(result[key] for result in results)
+                   for key in ('ready', 'first', 'second')]
+        print(f'{warmup:<24}' + ''.join(f'{value:>10.1f}' for value in medians))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='accounts.main:app startup benchmark')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    main(args.runs)
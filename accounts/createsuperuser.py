@@ -25,17 +25,19 @@ async def create_superuser(*, db=SessionLocal()) -> Any:
         user_in['password'] = getpass.getpass('Введите пароль:')
 
         user_in_data = jsonable_encoder(user_in)
-        user = await user_actions.get_by_attr_first(User, user_in_data['email'], 'email', db=db)
+        user = await user_actions.get_by_attr_lower_first(User, user_in_data['email'], 'email',
+                                                         db=db)
         
         if user:
             print("User with same email already exists")
         else:
             db_user = User(**user_in_data)
-            db_user.set_password(user_in_data['password'])
+            await db_user.set_password(user_in_data['password'])
             db_user.set_is_verified_false()
             db_user.set_is_superuser_true()
             db_user.set_created()
             user = await user_actions.create(db=db, db_obj=db_user)
+            await db.commit()
             print('Superuser was creaed.')
             print({'id': user.id, 'email': user.email})
     else:
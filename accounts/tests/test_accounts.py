@@ -1,9 +1,14 @@
 import pytest
+import pytest_asyncio
 import asyncio
+import json
 import random
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
 from faker import Faker
-from fastapi import Depends
+from fastapi import Depends, HTTPException
 
+from sqlalchemy import func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
@@ -12,9 +17,18 @@ from sqlalchemy.orm import sessionmaker, Session
 from app.app.config import settings
 
 from app.app import __version__
+from app.app.actions import BaseActions, encode_cursor, decode_cursor
+from app.app.query import Filter, QuerySpec, parse_filter
 from accounts.db import get_db, engine, SessionLocal
 from accounts.models import User
-from accounts.main import user_actions
+from accounts.hashing import Hasher
+from accounts.auth import Auth, token_cache
+from accounts.permissions import Principal
+from accounts.revocation import RevocationList
+from accounts.main import user_actions, serialize_user
+from accounts import schemas
+from app.app.serialization import dumps
+from app.app.write_behind import WriteBehindBuffer
 
 
 fake = Faker()
@@ -23,13 +37,22 @@ fake = Faker()
 @pytest.fixture
 def get_user():
     user = User(email=fake.ascii_email(), password='password')
-    user.set_password('password')
     user.set_is_verified_false()
     user.set_is_superuser_false()
     user.set_created()
     return user
 
 
+@pytest_asyncio.fixture
+async def db():
+    # Пул соединений привязан к циклу событий теста, поэтому после каждого теста
+    # соединения закрываются
+    session = SessionLocal()
+    yield session
+    await session.close()
+    await engine.dispose()
+
+
 @pytest.fixture
 def get_rand_attr():
     attr_list = [
@@ -50,9 +73,10 @@ class TestApp:
 #        assert  len(users) >= 0
 
     @pytest.mark.asyncio
-    async def test_get_attr(self, get_user, get_rand_attr, db=SessionLocal()):
+    async def test_get_attr(self, get_user, get_rand_attr, db):
         attr = get_rand_attr
         user = get_user
+        await user.set_password('password')
 
         users = await user_actions.get_all(User, 'created', db=db)
         assert  len(users) >= 0
@@ -64,6 +88,10 @@ class TestApp:
                                                            attr, db=db)
         assert getattr(user, attr) == getattr(user_readed, attr)
 
+        user_readed = await user_actions.get_by_attr_lower_first(User, user.email.upper(),
+                                                                 'email', db=db)
+        assert user_readed.id == user.id
+
         assert  len(await user_actions.get_by_attr_all(User, getattr(user, attr),
                                                        attr, db=db)) >= 0
         
@@ -71,5 +99,276 @@ class TestApp:
         user_readed = await user_actions.get_by_attr_first(User, user.id, 'id', db=db)
         assert not user_readed
 
-    def test_update(self):
-        pass
+    @pytest.mark.asyncio
+    async def test_batch_loader(self, get_user, db):
+        user = await user_actions.create(db, db_obj=get_user)
+        await db.commit()
+        sessions = [SessionLocal() for _ in range(3)]
+        user_actions.loader.start()
+        try:
+            queries = user_actions.loader.stats()['queries_total']
+            found = await asyncio.gather(
+                *(user_actions.get_by_attr_first(User, user.id, 'id', db=session, batch=True)
+                  for session in sessions),
+                user_actions.get_by_attr_first(User, uuid4(), 'id', db=sessions[0],
+                                               batch=True),
+            )
+            assert user_actions.loader.stats()['queries_total'] == queries + 1
+            assert [obj.email for obj in found[:3]] == [user.email] * 3
+            assert found[0] in sessions[0] and found[1] in sessions[1]
+            assert found[3] is None
+
+            # Запрос выполнен в сессии первого участника, остальные не заняли соединение
+            assert engine.sync_engine.pool.checkedout() == 1
+
+            # Без batch=True загрузчик не используется
+            assert (await user_actions.get_by_attr_first(User, user.id, 'id',
+                                                         db=sessions[1])).id == user.id
+            assert user_actions.loader.stats()['queries_total'] == queries + 1
+        finally:
+            user_actions.loader.stop()
+            for session in sessions:
+                await session.close()
+        await user_actions.remove(user, db=db)
+        await db.commit()
+
+    @pytest.mark.asyncio
+    async def test_count(self, get_user, db):
+        user = await user_actions.create(db, db_obj=get_user)
+        spec = QuerySpec(filters=[parse_filter(f'email:eq:{user.email}')])
+        assert await user_actions.count(User, db=db, query=spec) == 1
+        assert await user_actions.count(User, db=db) >= 1
+        estimate = await user_actions.count(User, db=db, query=spec, mode='estimated')
+        assert estimate >= 0
+        assert await user_actions.count(User, db=db, query=spec, mode='estimated') == estimate
+        assert await user_actions.count(User, db=db, mode='estimated') >= 0
+        with pytest.raises(ValueError):
+            await user_actions.count(User, db=db, mode='approximate')
+        await db.rollback()
+
+    @pytest.mark.asyncio
+    async def test_created_range(self, get_user, db):
+        user = await user_actions.create(db, db_obj=get_user)
+        second = timedelta(seconds=1)
+        spec = QuerySpec(filters=[parse_filter(f'email:eq:{user.email}'),
+                                  Filter(attr='created', op='gte', value=user.created - second),
+                                  Filter(attr='created', op='lt',
+                                         value=(user.created + second).isoformat())],
+                         order_by=['-created'])
+        assert [found.id for found in await user_actions.get_by_query_all(User, spec, db=db)] \
+            == [user.id]
+        spec.filters[1].value = user.created + second
+        assert await user_actions.get_by_query_all(User, spec, db=db) == []
+        await db.rollback()
+
+    @pytest.mark.asyncio
+    async def test_create_if_absent(self, db):
+        email = fake.ascii_email()
+        user_in = {'email': email, 'password': 'x', 'created': datetime.now(timezone.utc)}
+        user = await user_actions.create_if_absent(User, user_in, db=db,
+                                                   index_elements=[func.lower(User.email)])
+        assert user['email'] == email
+        assert await user_actions.create_if_absent(
+            User, {**user_in, 'email': email.upper()}, db=db,
+            index_elements=[func.lower(User.email)]
+        ) is None
+        await db.rollback()
+
+    @pytest.mark.asyncio
+    async def test_token_cache(self, get_user):
+        auth = Auth()
+        token = await auth.encode_token(get_user)
+        refresh_token = await auth.encode_refresh_token(get_user)
+        hits = token_cache.hits
+        assert await auth.decode_token(token) == await auth.decode_token(token)
+        assert token_cache.hits == hits + 1
+        for _ in range(2):
+            with pytest.raises(HTTPException):
+                await auth.decode_token(refresh_token)
+
+    @pytest.mark.asyncio
+    async def test_write_behind(self, get_user, db):
+        user = await user_actions.create(db=db, db_obj=get_user)
+        await db.commit()
+        buffer = WriteBehindBuffer(User, interval=60)
+        last_login = datetime.now(timezone.utc)
+        buffer.put(user.id, {'last_login': last_login - timedelta(minutes=1)})
+        buffer.put(user.id, {'last_login': last_login})
+        assert len(buffer) == 1
+        assert await buffer.flush(db) == 1
+        assert len(buffer) == 0
+        await db.refresh(user)
+        assert user.last_login == last_login
+        await user_actions.remove(user, db=db)
+        await db.commit()
+
+    @pytest.mark.asyncio
+    async def test_write_behind_stop(self, get_user, db, monkeypatch):
+        user = await user_actions.create(db=db, db_obj=get_user)
+        await db.commit()
+        update_from_values = BaseActions.update_from_values
+
+        async def slow_update_from_values(self, *args, **kwargs):
+            await asyncio.sleep(0.1)
+            return await update_from_values(self, *args, **kwargs)
+
+        monkeypatch.setattr(BaseActions, 'update_from_values', slow_update_from_values)
+        last_login = datetime.now(timezone.utc)
+        buffer = WriteBehindBuffer(User, interval=60)
+        await buffer.start(SessionLocal)
+        # Отмененная запись возвращает значения в буфер
+        buffer.put(user.id, {'last_login': last_login - timedelta(minutes=1)})
+        buffer._wakeup.set()
+        await asyncio.sleep(0.05)
+        buffer._task.cancel()
+        await asyncio.sleep(0)
+        assert len(buffer) == 1
+        # Остановка во время записи дожидается ее и записывает остальное
+        await buffer.start(SessionLocal)
+        buffer._wakeup.set()
+        await asyncio.sleep(0.05)
+        buffer.put(user.id, {'last_login': last_login})
+        await buffer.stop()
+        assert len(buffer) == 0
+        await db.refresh(user)
+        assert user.last_login == last_login
+        await user_actions.remove(user, db=db)
+        await db.commit()
+
+    @pytest.mark.asyncio
+    async def test_update(self, get_user, db):
+        user = await user_actions.create(db=db, db_obj=get_user)
+        row = await user_actions.update_by_id(User, user.id, {'first_name': 'John'}, db=db)
+        assert row['first_name'] == 'John'
+        assert row['email'] == user.email
+        assert await user_actions.update_by_id(User, uuid4(), {'first_name': 'John'},
+                                               db=db) is None
+        await db.rollback()
+
+    def test_user_update_schema(self):
+        assert schemas.UserUpdate(first_name='John').dict(exclude_unset=True) == \
+            {'first_name': 'John'}
+        with pytest.raises(ValueError):
+            schemas.UserUpdate(email=None)
+
+    def test_serializer(self, get_user):
+        user = get_user
+        user.id = uuid4()
+        user.set_is_active_true()
+        assert serialize_user(user) == schemas.User.from_orm(user).dict()
+        assert json.loads(dumps(serialize_user(user))) == json.loads(
+            schemas.User.from_orm(user).json()
+        )
+
+    def test_cursor(self):
+        user = User(id=uuid4(), created=datetime.now(timezone.utc))
+        cursor = encode_cursor([user.created, user.id])
+        assert decode_cursor(cursor, (User.created, User.id)) == [user.created, user.id]
+        with pytest.raises(ValueError):
+            decode_cursor('invalid', (User.created, User.id))
+
+    @pytest.mark.asyncio
+    async def test_get_all_by_cursor(self, db):
+        users, next_cursor = await user_actions.get_all_by_cursor(User, 'created', db=db, limit=1)
+        assert len(users) <= 1
+        if next_cursor:
+            next_users, _ = await user_actions.get_all_by_cursor(User, 'created', db=db,
+                                                                 cursor=next_cursor, limit=1)
+            assert next_users[0].id != users[0].id
+            assert (next_users[0].created, next_users[0].id) < (users[0].created, users[0].id)
+
+    @pytest.mark.asyncio
+    async def test_fields(self, get_user, db):
+        user = await user_actions.create(db=db, db_obj=get_user)
+        row = await user_actions.get_row_by_attr_first(User, user.id, 'id', ['email'], db=db)
+        assert dict(row) == {'email': user.email}
+
+        rows, _ = await user_actions.get_all_by_cursor(User, 'created', db=db, limit=1,
+                                                       fields=['email'])
+        assert set(rows[0].keys()) == {'email', 'created', 'id'}
+
+        with pytest.raises(ValueError):
+            await user_actions.get_all(User, 'created', db=db, fields=['password'])
+
+    @pytest.mark.asyncio
+    async def test_stream_all(self, db):
+        users = [user async for user in user_actions.stream_all(User, 'created', db=db,
+                                                                fetch_size=2)]
+        assert len(users) == len(await user_actions.get_all(User, 'created', db=db,
+                                                            limit=len(users) + 1))
+
+    @pytest.mark.asyncio
+    async def test_bulk(self, db):
+        rows = [{'email': fake.ascii_email(), 'created': datetime.now(timezone.utc)} for _ in range(3)]
+        users = await user_actions.create_many(User, rows, db=db, chunk_size=2)
+        ids = [user['id'] for user in users]
+        assert len(set(ids)) == 3
+
+        updated = await user_actions.update_many(User, ids, {'first_name': 'John'}, db=db)
+        assert set(updated) == set(ids)
+        users = await user_actions.get_by_attr_in(User, ids, 'id', db=db)
+        assert {user.first_name for user in users} == {'John'}
+
+        # Конфликт с существующим email пропускается, остальные записи создаются
+        row = {'email': fake.ascii_email(), 'created': datetime.now(timezone.utc)}
+        users = await user_actions.create_many(
+            User, [{**rows[0], 'email': rows[0]['email'].upper()}, row], db=db,
+            index_elements=[func.lower(User.email)]
+        )
+        assert [user['email'] for user in users] == [row['email']]
+        ids.append(users[0]['id'])
+
+        removed = await user_actions.remove_many(User, ids + [uuid4()], db=db, chunk_size=2)
+        assert set(removed) == set(ids)
+
+    @pytest.mark.asyncio
+    async def test_revocation_list(self, get_user, db):
+        user = get_user
+        user.is_active = True
+        user.set_is_superuser_true()
+        await user_actions.create(db=db, db_obj=user)
+        claims = Auth.subject(user)
+        revocation_list = RevocationList(interval=10)
+
+        await revocation_list.refresh(db)
+        assert revocation_list.check(Principal.from_claims(claims), claims['token_version'])
+
+        user.set_is_superuser_false()
+        await user_actions.update(db=db, db_obj=user, obj_in={})
+        await revocation_list.refresh(db)
+        with pytest.raises(HTTPException) as e:
+            revocation_list.check(Principal.from_claims(claims), claims['token_version'])
+        assert e.value.status_code == 401
+
+        # Изменение email через UPDATE ... RETURNING увеличивает версию токенов
+        row = await user_actions.update_by_id(User, user.id, {'email': fake.ascii_email()},
+                                              db=db)
+        assert row['token_version'] == claims['token_version'] + 2
+
+        # Отзыв старше времени жизни access токена в список не загружается
+        await user_actions.update_by_id(User, user.id,
+                                        {'revoked': row['revoked'] - timedelta(hours=1)}, db=db)
+        await revocation_list.refresh(db)
+        assert revocation_list.check(Principal.from_claims(claims), claims['token_version'])
+
+        claims = Auth.subject(user)
+        await user_actions.remove(user, db=db)
+        await db.commit()
+        await revocation_list.refresh(db)
+        with pytest.raises(HTTPException) as e:
+            revocation_list.check(Principal.from_claims(claims), row['token_version'])
+        assert e.value.status_code == 401
+        await revocation_list.prune(db)
+
+    @pytest.mark.asyncio
+    async def test_hasher(self):
+        hasher = Hasher(workers=2, max_queue=2)
+        encoded_password = await hasher.hash('password')
+        assert await hasher.verify('password', encoded_password)
+        assert not await hasher.verify('wrong', encoded_password)
+
+        with pytest.raises(HTTPException) as e:
+            await asyncio.gather(*(hasher.hash('password') for _ in range(3)))
+        assert e.value.status_code == 503
+        assert hasher.metrics()['rejected_total'] == 1
+        hasher.shutdown()
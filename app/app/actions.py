@@ -1,12 +1,28 @@
-from typing import Any, Dict, Generic, List, Optional, Type, TypeVar, Union
+import asyncio
+import base64
+import binascii
+import json
+from typing import (Any, AsyncIterator, Callable, Dict, Generic, List, Optional, Sequence,
+                    Tuple, Type, TypeVar, Union)
 
 from fastapi.encoders import jsonable_encoder
 from pydantic import UUID4, BaseModel
 from sqlalchemy.orm import Session, Query
 from sqlalchemy import desc
+from sqlalchemy import event
+from sqlalchemy import func
 from sqlalchemy import select
+from sqlalchemy import tuple_
+from sqlalchemy import insert, update, delete
+from sqlalchemy import column, values
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import SQLAlchemyError
 
+from .cache import TTLCache
+from .config import settings
+from .query import QuerySpec, coerce_value, plan_rows, query_compiler
+
 
 # Определяем абстрактные типы для SQLAlchemy модели, и Pydantic схем
 ModelType = TypeVar("ModelType", bound=BaseModel)
@@ -14,59 +30,313 @@ CreateSchemaType = TypeVar("CreateSchemaType", bound=BaseModel)
 UpdateSchemaType = TypeVar("UpdateSchemaType", bound=BaseModel)
 
 
+def encode_cursor(values: Sequence[Any]) -> str:
+    """
+    Закодировать значения ключа сортировки последней записи страницы в непрозрачный
+    курсор
+    """
+    raw = json.dumps(jsonable_encoder(list(values)), separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, columns: Sequence[Any]) -> List[Any]:
+    """
+    Раскодировать курсор в значения ключа сортировки, приведенные к python-типам
+    колонок `columns`. При некорректном курсоре возбуждается ValueError.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('Invalid cursor')
+    try:
+        return [coerce_value(column, value) for column, value in zip(columns, values)]
+    except ValueError:
+        raise ValueError('Invalid cursor')
+
+
+def _chunks(items: Sequence[Any], chunk_size: int):
+    """Разбить последовательность `items` на порции длиной не больше `chunk_size`"""
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    """Оповещение обработчиков изменений после фиксации транзакции"""
+    BaseActions._dispatch_changed(session)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    """Отмена оповещений об изменениях при откате транзакции"""
+    session.info.pop('changed', None)
+
+
+class BatchLoader():
+    """
+    Загрузчик, объединяющий поиск записей по значению атрибута. Запросы (модель,
+    атрибут, значение), поступившие от разных корутин за один проход цикла событий,
+    выполняются одним запросом SELECT ... WHERE attr IN (...) порциями по
+    `max_batch_size` значений; одинаковые значения запрашиваются один раз. Значения
+    сравниваются по строковому представлению.
+
+    Запрос порции выполняется на основной БД в сессии первого из ожидающих ее запросов,
+    поэтому запрос приложения по-прежнему занимает не больше одного соединения пула, а
+    запрос к БД учитывается в его бюджете. Остальным запросам найденные объекты
+    возвращаются присоединенными к этой сессии. До вызова `start` загрузчик не
+    используется.
+    """
+
+    def __init__(self, max_batch_size: int = 1000):
+        self.max_batch_size = max_batch_size
+        self.enabled = False
+        # (модель, атрибут) -> {строковое значение: (значение, future, сессия)}
+        self._pending: Dict[Tuple[Any, str],
+                            Dict[str, Tuple[Any, asyncio.Future, Session]]] = {}
+        self._scheduled = False
+        self._counters = {'loads_total': 0, 'keys_total': 0, 'queries_total': 0}
+
+    def start(self):
+        """Начать объединение запросов"""
+        self.enabled = True
+
+    def stop(self):
+        """Прекратить объединение запросов"""
+        self.enabled = False
+
+    async def load(self, model, attr_name: str, attr_value: Any,
+                   db: Session) -> Optional[Any]:
+        """
+        Получить первый экземпляр `model` с атрибутом `attr_name`, равным `attr_value`.
+        Сессия `db` может быть использована для запроса порции, в которую попало значение.
+        """
+        self._counters['loads_total'] += 1
+        batch = self._pending.setdefault((model, attr_name), {})
+        key = str(attr_value)
+        item = batch.get(key)
+        if item is None:
+            item = batch[key] = (attr_value, asyncio.get_running_loop().create_future(), db)
+            self._counters['keys_total'] += 1
+            if not self._scheduled:
+                self._scheduled = True
+                asyncio.get_running_loop().call_soon(self._dispatch)
+        # Отмена одной из ожидающих корутин не должна отменять общий результат
+        return await asyncio.shield(item[1])
+
+    def _dispatch(self):
+        """Запустить запросы для значений, накопленных за проход цикла событий"""
+        pending, self._pending = self._pending, {}
+        self._scheduled = False
+        asyncio.ensure_future(self._load_all(pending))
+
+    async def _load_all(self, pending):
+        """
+        Выполнить запросы порций по очереди: одна сессия может оказаться первой в
+        нескольких порциях, а сессия не допускает одновременных запросов
+        """
+        for (model, attr_name), batch in pending.items():
+            for chunk in _chunks(list(batch.items()), self.max_batch_size):
+                await self._load_batch(model, attr_name, chunk)
+
+    async def _load_batch(self, model, attr_name: str,
+                          chunk: Sequence[Tuple[str, Tuple[Any, asyncio.Future, Session]]]):
+        """Выполнить один запрос для порции значений и передать результаты ожидающим"""
+        self._counters['queries_total'] += 1
+        db = chunk[0][1][2]
+        try:
+            result = await db.execute(
+                select(model).filter(
+                    getattr(model, attr_name).in_([value for _, (value, _, _) in chunk])
+                )
+            )
+            objs = result.scalars().all()
+        except Exception as e:
+            for _, (_, future, _) in chunk:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        found: Dict[str, Any] = {}
+        for obj in objs:
+            found.setdefault(str(getattr(obj, attr_name)), obj)
+        for key, (_, future, _) in chunk:
+            if not future.done():
+                future.set_result(found.get(key))
+
+    def stats(self) -> Dict[str, Any]:
+        """Число запрошенных и уникальных значений и выполненных запросов"""
+        return dict(self._counters)
+
+
 class BaseActions(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
     """
-    Базовый класс, содержащий CRUD методы для взаимодействия с БД
+    Базовый класс, содержащий CRUD методы для взаимодействия с БД.
+    Методы выполняются в транзакции сессии `db`, которой управляет вызывающий код
+    (для запросов API - middleware сессии запроса). Методы массовых операций фиксируют
+    транзакцию после каждой порции записей. Запросы методов чтения помечены параметром
+    выполнения `replica=True`: сессия `RoutingSession` может выполнить их на реплике.
     """
 
+    # Атрибуты, допустимые в спецификациях запросов get_by_query_all (None - все колонки)
+    query_attrs: Optional[Tuple[str, ...]] = None
+
+    # Загрузчик, объединяющий запросы get_by_attr_first(batch=True) разных сессий
+    loader = BatchLoader()
+
+    # Кэш оценок числа записей count(mode='estimated')
+    count_cache = TTLCache(1024, settings.COUNT_ESTIMATE_TTL)
+
+    # Обработчики изменения записей: для каждой модели - список функций, которые
+    # получают идентификаторы измененных или удаленных записей
+    _change_listeners: Dict[Any, List[Callable[[Sequence[Any]], None]]] = {}
+
+    @classmethod
+    def add_change_listener(cls, model, listener: Callable[[Sequence[Any]], None]):
+        """
+        Зарегистрировать функцию `listener`, вызываемую с идентификаторами записей
+        объекта `model` после их изменения или удаления
+        """
+        cls._change_listeners.setdefault(model, []).append(listener)
+
+    @classmethod
+    def _notify_changed(cls, db: Session, model, ids: Sequence[Any]):
+        """
+        Запомнить изменение записей объекта `model` в сессии `db`: обработчики будут
+        оповещены после фиксации транзакции
+        """
+        db.sync_session.info.setdefault('changed', []).append((model, list(ids)))
+
+    @classmethod
+    def _dispatch_changed(cls, session):
+        """Оповестить обработчики об изменениях, зафиксированных в сессии `session`"""
+        for model, ids in session.info.pop('changed', ()):
+            for listener in cls._change_listeners.get(model, ()):
+                listener(ids)
+
+    def _select(self, model, fields: Optional[Sequence[str]] = None):
+        """
+        Выражение выборки объекта `model` целиком или, если задан набор атрибутов
+        `fields`, только этих колонок из числа допустимых `query_attrs`
+        """
+        if not fields:
+            return select(model)
+        for attr in fields:
+            if (attr not in model.__table__.columns or
+                    (self.query_attrs is not None and attr not in self.query_attrs)):
+                raise ValueError(f'Attribute is not allowed: {attr!r}')
+        return select(*(getattr(model, attr) for attr in fields))
+
     async def get_all(self, model, obj_ordered_attr: str,
                       db: Session, *, skip: int = 0,
-                      limit: int = 100) -> List[ModelType]:
+                      limit: int = 100,
+                      fields: Optional[Sequence[str]] = None) -> List[Any]:
         """
         Получить все экземпляры объекта `model`, содержащиеся в БД, по которой открыта 
-        сессия `db`. Отсортировать полученные объекты по атрибуту `obj_ordered_attr` 
+        сессия `db`. Отсортировать полученные объекты по атрибуту `obj_ordered_attr`.
+        Если задан набор атрибутов `fields`, выбираются только эти колонки и вместо
+        объектов возвращаются строки-словари.
         """
         try:
             result = await db.execute(
-                select(model).order_by(desc(getattr(model, obj_ordered_attr, None))
+                self._select(model, fields).order_by(desc(getattr(model, obj_ordered_attr, None))
                 ).offset(
                     skip
                 ).limit(
                     limit
+                ).execution_options(
+                    replica=True
                 )
             )
-            result = result.scalars().all()
-            await db.close()
+            result = result.mappings().all() if fields else result.scalars().all()
             return result
         except SQLAlchemyError as e:
             raise e
-        finally:
-            await db.close()
 
     @classmethod
     async def get_by_attr_first(self, model, 
                           attr_value, 
                           attr_name: str, 
-                          db: Session) -> Optional[ModelType]:
+                          db: Session, *,
+                          batch: bool = False) -> Optional[ModelType]:
         """
         Получить первый экземпляр объекта `model` из БД `db` по атрибуту `attr_name`, 
         имеющим значение `attr_value`.
+        Запрос помечается `replica=True`. При `batch=True` запрос выполняется на основной
+        БД (например, для проверки прав пользователя), и, если загрузчик `loader` запущен,
+        а сессия не содержит несохраненных изменений, объединяется с запросами других
+        сессий и выполняется в сессии одной из них; найденный объект добавляется в сессию
+        `db`. Если объединенный запрос не удался (например, сессия, в которой он
+        выполнялся, закрыта), запрос повторяется в сессии `db`.
         """
+        if (batch and self.loader.enabled and
+                not (db.sync_session.new or db.sync_session.deleted or
+                     db.sync_session.dirty)):
+            try:
+                obj = await self.loader.load(model, attr_name, attr_value, db)
+                return await db.merge(obj, load=False) if obj is not None else None
+            except Exception:
+                pass
         try:
             result = await db.execute(
                 select(model).filter(
                     getattr(model, attr_name, None)==attr_value
-                ).order_by(
-                    desc(getattr(model, attr_name, None))
+                ).limit(
+                    1
+                ).execution_options(
+                    replica=not batch
                 )
             )
             result = result.scalars().first()
-            await db.close()
             return result
         except SQLAlchemyError as e:
             raise e
-        finally:
-            await db.close()
+
+    async def get_by_attr_lower_first(self, model,
+                                      attr_value: str,
+                                      attr_name: str,
+                                      db: Session) -> Optional[ModelType]:
+        """
+        Получить первый экземпляр объекта `model` из БД `db` с атрибутом `attr_name`,
+        совпадающим со значением `attr_value` без учета регистра. Условие записано как
+        `lower(attr_name) = lower(attr_value)`, чтобы использовать функциональный индекс.
+        """
+        try:
+            result = await db.execute(
+                select(model).filter(
+                    func.lower(getattr(model, attr_name, None))==func.lower(attr_value)
+                ).limit(
+                    1
+                )
+            )
+            return result.scalars().first()
+        except SQLAlchemyError as e:
+            raise e
+
+    async def get_row_by_attr_first(self, model,
+                                    attr_value,
+                                    attr_name: str,
+                                    fields: Sequence[str],
+                                    db: Session) -> Optional[Dict[str, Any]]:
+        """
+        Получить строку-словарь с атрибутами `fields` первого экземпляра объекта `model`
+        из БД `db` с атрибутом `attr_name`, имеющим значение `attr_value`, без создания
+        объекта ORM
+        """
+        try:
+            result = await db.execute(
+                self._select(model, fields).filter(
+                    getattr(model, attr_name, None)==attr_value
+                ).limit(
+                    1
+                ).execution_options(
+                    replica=True
+                )
+            )
+            return result.mappings().first()
+        except SQLAlchemyError as e:
+            raise e
 
     async def get_by_attr_all(self, model,
                               attr_value,
@@ -88,15 +358,152 @@ class BaseActions(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
                     skip
                 ).limit(
                     limit
+                ).execution_options(
+                    replica=True
+                )
+            )
+            result = result.scalars().all()
+            return result
+        except SQLAlchemyError as e:
+            raise e
+
+    async def get_by_attr_in(self, model,
+                             attr_values: Sequence[Any],
+                             attr_name: str,
+                             db: Session) -> List[ModelType]:
+        """
+        Получить все экземпляры объекта `model` из БД `db`, у которых атрибут `attr_name`
+        имеет одно из значений `attr_values`, одним запросом.
+        """
+        try:
+            result = await db.execute(
+                select(model).filter(
+                    getattr(model, attr_name, None).in_(attr_values)
                 )
             )
             result = result.scalars().all()
-            await db.close()
             return result
         except SQLAlchemyError as e:
             raise e
-        finally:
-            await db.close()
+
+    async def get_by_attr_lower_in(self, model,
+                                   attr_values: Sequence[str],
+                                   attr_name: str,
+                                   db: Session) -> List[ModelType]:
+        """
+        Получить все экземпляры объекта `model` из БД `db`, у которых атрибут `attr_name`
+        без учета регистра совпадает с одним из значений `attr_values`, одним запросом.
+        """
+        try:
+            result = await db.execute(
+                select(model).filter(
+                    func.lower(getattr(model, attr_name, None)).in_(
+                        [value.lower() for value in attr_values]
+                    )
+                )
+            )
+            return result.scalars().all()
+        except SQLAlchemyError as e:
+            raise e
+
+    @staticmethod
+    async def _get_page_by_cursor(query, order_columns: Sequence[Any], db: Session,
+                                  cursor: Optional[str], limit: int,
+                                  rows: bool = False) -> Tuple[List[Any], Optional[str]]:
+        """
+        Выполнить запрос `query` с постраничной выборкой по курсору: записи сортируются
+        по убыванию `order_columns`, страница начинается сразу после записи, ключ
+        которой закодирован в `cursor`. Стоимость запроса не зависит от номера страницы.
+        При `rows` запрос выбирает отдельные колонки и возвращает строки-словари.
+        """
+        if cursor:
+            cursor_values = decode_cursor(cursor, order_columns)
+            query = query.filter(tuple_(*order_columns) < tuple_(*cursor_values))
+        result = await db.execute(
+            query.order_by(
+                *(desc(column) for column in order_columns)
+            ).limit(
+                limit + 1
+            ).execution_options(
+                replica=True
+            )
+        )
+        result = result.mappings().all() if rows else result.scalars().all()
+        next_cursor = None
+        if len(result) > limit:
+            result = result[:limit]
+            last = result[-1]
+            next_cursor = encode_cursor([last[column.key] if rows else getattr(last, column.key)
+                                         for column in order_columns])
+        return result, next_cursor
+
+    async def get_all_by_cursor(self, model, obj_ordered_attr: str,
+                                db: Session, *, cursor: Optional[str] = None,
+                                limit: int = 100, fields: Optional[Sequence[str]] = None
+                                ) -> Tuple[List[Any], Optional[str]]:
+        """
+        Получить страницу экземпляров объекта `model`, отсортированных по атрибуту
+        `obj_ordered_attr` и `id`, начиная с позиции `cursor`. Возвращает список объектов
+        и курсор следующей страницы (None для последней страницы). Если задан набор
+        атрибутов `fields`, возвращаются строки-словари с этими атрибутами и атрибутами
+        сортировки.
+        """
+        order_columns = (getattr(model, obj_ordered_attr), getattr(model, 'id'))
+        if fields:
+            fields = list(fields) + [column.key for column in order_columns
+                                     if column.key not in fields]
+        try:
+            result = await self._get_page_by_cursor(
+                self._select(model, fields), order_columns,
+                db, cursor, limit, rows=bool(fields)
+            )
+            return result
+        except SQLAlchemyError as e:
+            raise e
+
+    async def get_by_attr_all_by_cursor(self, model,
+                                        attr_value,
+                                        attr_name: str,
+                                        db: Session, *,
+                                        cursor: Optional[str] = None,
+                                        limit: int = 100) -> Tuple[List[ModelType], Optional[str]]:
+        """
+        Получить страницу экземпляров объекта `model` с атрибутом `attr_name`, имеющим
+        значение `attr_value`, отсортированных по `id`, начиная с позиции `cursor`.
+        """
+        try:
+            result = await self._get_page_by_cursor(
+                select(model).filter(
+                    getattr(model, attr_name, None)==attr_value
+                ),
+                (getattr(model, 'id'),),
+                db, cursor, limit
+            )
+            return result
+        except SQLAlchemyError as e:
+            raise e
+
+    async def stream_all(self, model, obj_ordered_attr: str,
+                         db: Session, *, fetch_size: int = 1000) -> AsyncIterator[ModelType]:
+        """
+        Асинхронный генератор всех экземпляров объекта `model`, отсортированных по
+        атрибуту `obj_ordered_attr`. Записи читаются серверным курсором порциями по
+        `fetch_size` строк, поэтому расход памяти не зависит от размера таблицы.
+        """
+        try:
+            result = await db.stream(
+                select(model).order_by(
+                    desc(getattr(model, obj_ordered_attr, None))
+                ).execution_options(
+                    yield_per=fetch_size,
+                    replica=True
+                )
+            )
+            async for partition in result.scalars().partitions(fetch_size):
+                for obj in partition:
+                    yield obj
+        except SQLAlchemyError as e:
+            raise e
 
     async def create(self, db: Session, *, db_obj: CreateSchemaType) -> ModelType:
         """
@@ -104,14 +511,129 @@ class BaseActions(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         """
         try:
             db.add(db_obj)
-            await db.commit()
+            await db.flush()
             await db.refresh(db_obj)
-            await db.close()
             return db_obj
         except SQLAlchemyError as e:
             raise e
-        finally:
-            await db.close()
+
+    async def create_if_absent(self, model, obj_in: Dict[str, Any], db: Session, *,
+                               index_elements: Sequence[Any]) -> Optional[Dict[str, Any]]:
+        """
+        Создать в БД `db` запись объекта `model` со значениями из словаря `obj_in` одним
+        запросом INSERT ... ON CONFLICT DO NOTHING RETURNING. `index_elements` - колонки
+        или выражения уникального индекса, по которому определяется конфликт. Возвращает
+        созданную строку или None, если запись с тем же ключом уже существует.
+        """
+        table = model.__table__
+        try:
+            result = await db.execute(
+                pg_insert(table).values(obj_in).on_conflict_do_nothing(
+                    index_elements=index_elements
+                ).returning(*table.c)
+            )
+            return result.mappings().first()
+        except SQLAlchemyError as e:
+            raise e
+
+    async def create_many(self, model, objs_in: Sequence[Dict[str, Any]],
+                          db: Session, *, chunk_size: int = 1000,
+                          index_elements: Optional[Sequence[Any]] = None
+                          ) -> List[Dict[str, Any]]:
+        """
+        Создать в БД `db` записи объекта `model` со значениями из словарей `objs_in`.
+        Записи вставляются многострочным INSERT ... RETURNING порциями по `chunk_size`,
+        каждая порция фиксируется отдельной транзакцией. Если заданы `index_elements` -
+        колонки или выражения уникального индекса, - используется INSERT ... ON CONFLICT
+        DO NOTHING: записи, конфликтующие с существующими (в том числе вставленными
+        одновременно другими запросами), пропускаются. Возвращает созданные строки.
+        """
+        table = model.__table__
+        created = []
+        try:
+            for chunk in _chunks(objs_in, chunk_size):
+                if index_elements is None:
+                    statement = insert(table).values(list(chunk))
+                else:
+                    statement = pg_insert(table).values(list(chunk)).on_conflict_do_nothing(
+                        index_elements=index_elements
+                    )
+                result = await db.execute(statement.returning(*table.c))
+                created.extend(result.mappings().all())
+                await db.commit()
+            return created
+        except SQLAlchemyError as e:
+            await db.rollback()
+            raise e
+
+    async def update_many(self, model, ids: Sequence[Any],
+                          obj_in: Dict[str, Any], db: Session, *,
+                          chunk_size: int = 1000) -> List[Any]:
+        """
+        Обновить в БД `db` записи объекта `model` с идентификаторами `ids` значениями из
+        словаря `obj_in` запросами UPDATE ... WHERE id IN (...) порциями по `chunk_size`.
+        Возвращает идентификаторы обновленных записей.
+        """
+        table = model.__table__
+        updated = []
+        try:
+            for chunk in _chunks(ids, chunk_size):
+                result = await db.execute(
+                    update(table).where(
+                        table.c.id.in_(chunk)
+                    ).values(
+                        **obj_in
+                    ).returning(
+                        table.c.id
+                    )
+                )
+                chunk_ids = result.scalars().all()
+                self._notify_changed(db, model, chunk_ids)
+                await db.commit()
+                updated.extend(chunk_ids)
+            return updated
+        except SQLAlchemyError as e:
+            await db.rollback()
+            raise e
+
+    async def update_from_values(self, model, rows: Sequence[Dict[str, Any]],
+                                 db: Session, *, chunk_size: int = 1000,
+                                 notify: bool = True) -> int:
+        """
+        Обновить в БД `db` записи объекта `model` значениями из словарей `rows`, каждый из
+        которых содержит `id` и одинаковый набор обновляемых атрибутов. Записи обновляются
+        запросами UPDATE ... FROM (VALUES ...) порциями по `chunk_size`, каждая порция
+        фиксируется отдельной транзакцией. При `notify=False` обработчики изменений не
+        оповещаются. Возвращает число обновленных записей.
+        """
+        if not rows:
+            return 0
+        table = model.__table__
+        attrs = [attr for attr in rows[0] if attr != 'id']
+        updated = 0
+        try:
+            for chunk in _chunks(rows, chunk_size):
+                data = values(
+                    *(column(attr, table.c[attr].type) for attr in ['id', *attrs]),
+                    name='data'
+                ).data(
+                    [tuple(row[attr] for attr in ['id', *attrs]) for row in chunk]
+                )
+                result = await db.execute(
+                    update(table).where(
+                        table.c.id == data.c.id
+                    ).values(
+                        {attr: data.c[attr] for attr in attrs}
+                    )
+                )
+                if notify:
+                    self._notify_changed(db, model, [row['id'] for row in chunk])
+                await db.commit()
+                updated += result.rowcount
+            return updated
+        except SQLAlchemyError as e:
+            await db.rollback()
+            raise e
 
     async def update(self, db: Session, *, db_obj: ModelType, 
                      obj_in: Union[UpdateSchemaType, Dict[str, Any]]) -> ModelType:
@@ -120,23 +642,58 @@ class BaseActions(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         словаре `obj_in`.
         """
         try:
-            obj_data = jsonable_encoder(db_obj)
-            if isinstance(obj_in, dict):
-                update_data = obj_in
-            else:
-                update_data = obj_in.dict(exclude_unset=True)
-            for field in obj_data:
-                if field in update_data:
-                    setattr(db_obj, field, update_data[field])
+            update_data = self._update_data(type(db_obj), obj_in)
+            for field in update_data:
+                setattr(db_obj, field, update_data[field])
             db.add(db_obj)
-            await db.commit()
+            await db.flush()
             await db.refresh(db_obj)
-            await db.close()
+            self._notify_changed(db, type(db_obj), [db_obj.id])
             return db_obj
         except SQLAlchemyError as e:
             raise e
-        finally:
-            await db.close()
+
+    @staticmethod
+    def _update_data(model, obj_in: Union[UpdateSchemaType, Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Значения колонок объекта `model` из словаря или схемы `obj_in` (из схемы берутся
+        только явно заданные поля)
+        """
+        if not isinstance(obj_in, dict):
+            obj_in = obj_in.dict(exclude_unset=True)
+        columns = model.__table__.columns
+        return {field: value for field, value in obj_in.items() if field in columns}
+
+    async def update_by_id(self, model, id: Any,
+                           obj_in: Union[UpdateSchemaType, Dict[str, Any]],
+                           db: Session) -> Optional[Dict[str, Any]]:
+        """
+        Обновить в БД `db` запись объекта `model` с идентификатором `id` данными из
+        словаря или схемы `obj_in` одним запросом UPDATE ... RETURNING, без
+        предварительной выборки объекта. Возвращает обновленную строку-словарь или None,
+        если записи нет.
+        """
+        table = model.__table__
+        update_data = self._update_data(model, obj_in)
+        try:
+            if not update_data:
+                result = await db.execute(select(table).where(table.c.id == id))
+                return result.mappings().first()
+            result = await db.execute(
+                update(table).where(
+                    table.c.id == id
+                ).values(
+                    **update_data
+                ).returning(
+                    *table.c
+                )
+            )
+            row = result.mappings().first()
+            if row is not None:
+                self._notify_changed(db, model, [id])
+            return row
+        except SQLAlchemyError as e:
+            raise e
 
     async def remove(self, obj, *, db: Session) -> ModelType:
         """
@@ -144,23 +701,117 @@ class BaseActions(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         """
         try:
             await db.delete(obj)
-            await db.commit()
-            await db.close()
+            await db.flush()
+            self._notify_changed(db, type(obj), [obj.id])
             return obj
         except SQLAlchemyError as e:
             raise e
-        finally:
-            await db.close()
 
+    async def remove_many(self, model, ids: Sequence[Any], db: Session, *,
+                          chunk_size: int = 1000) -> List[Any]:
+        """
+        Удалить из БД `db` записи объекта `model` с идентификаторами `ids` запросами
+        DELETE ... WHERE id IN (...) порциями по `chunk_size`. Возвращает идентификаторы
+        удаленных записей.
+        """
+        table = model.__table__
+        removed = []
+        try:
+            for chunk in _chunks(ids, chunk_size):
+                result = await db.execute(
+                    delete(table).where(
+                        table.c.id.in_(chunk)
+                    ).returning(
+                        table.c.id
+                    )
+                )
+                chunk_ids = result.scalars().all()
+                self._notify_changed(db, model, chunk_ids)
+                await db.commit()
+                removed.extend(chunk_ids)
+            return removed
+        except SQLAlchemyError as e:
+            await db.rollback()
+            raise e
 
     async def get_by_query_all(self, model,
-                              query: Query,
-                              db: Session, *,
-                              skip: int = 0,
-                              limit: int = 100) -> Optional[ModelType]:
+                               query: QuerySpec,
+                               db: Session, *,
+                               skip: int = 0,
+                               limit: int = 100) -> List[Any]:
         """
-        TODO
-        Получить все экземпляры объекта `model` из БД `db` по запросу `query`
+        Получить экземпляры объекта `model` из БД `db` по спецификации запроса `query`:
+        фильтры eq, in, gt/gte/lt/lte, prefix, is_null и сортировка по нескольким
+        атрибутам. Если в спецификации задан набор атрибутов `fields`, возвращаются
+        строки с этими атрибутами вместо объектов. Допустимые атрибуты ограничиваются
+        `query_attrs`.
         """
+        try:
+            statement, params = query_compiler.compile(model, query, allowed=self.query_attrs)
+            result = await db.execute(statement.execution_options(replica=True),
+                                      {**params, '_skip': skip, '_limit': limit})
+            if query.fields:
+                return result.mappings().all()
+            return result.scalars().all()
+        except SQLAlchemyError as e:
+            raise e
+
+    async def count(self, model, db: Session, *,
+                    query: Optional[QuerySpec] = None,
+                    mode: str = 'exact') -> int:
+        """
+        Получить число записей объекта `model` в БД `db`, удовлетворяющих фильтрам
+        спецификации `query` (None - все записи):
+
+            exact - запрос SELECT count(*) с фильтрами, читает все подходящие записи;
+            estimated - оценка планировщика без чтения записей: без фильтров -
+                        pg_class.reltuples, с фильтрами - число строк из плана EXPLAIN
+                        выборки без агрегации.
+                        Оценка кэшируется в `count_cache`.
 
-        pass
+        Если таблица еще не анализировалась (reltuples < 0 или reltuples = 0 при
+        relpages = 0), оценка берется из плана запроса.
+        """
+        spec = query or QuerySpec()
+        try:
+            statement, params = query_compiler.compile_count(model, spec,
+                                                             allowed=self.query_attrs)
+            if mode == 'exact':
+                return await db.scalar(statement.execution_options(replica=True), params)
+            if mode != 'estimated':
+                raise ValueError(f'Invalid count mode: {mode!r}')
+            key = (model, tuple((item.attr, item.op, str(item.value))
+                                for item in spec.filters))
+            estimate = self.count_cache.get(key)
+            if estimate is not None:
+                return estimate
+            estimate = None
+            if not spec.filters:
+                result = await db.execute(
+                    text(
+                        'SELECT reltuples, relpages FROM pg_class '
+                        'WHERE oid = to_regclass(:table)'
+                    ).bindparams(
+                        table=model.__table__.fullname
+                    ).execution_options(
+                        replica=True
+                    )
+                )
+                row = result.first()
+                # До первого ANALYZE reltuples равен -1 (PostgreSQL 14+) или 0 при
+                # relpages = 0 (более ранние версии)
+                if row is not None and not (row.reltuples < 0 or
+                                            (row.reltuples == 0 and row.relpages == 0)):
+                    estimate = row.reltuples
+            if estimate is None:
+                statement, params = query_compiler.compile_estimate(
+                    model, spec, allowed=self.query_attrs
+                )
+                estimate = plan_rows(await db.scalar(
+                    statement.execution_options(replica=True), params
+                ))
+            estimate = int(round(estimate))
+            self.count_cache.set(key, estimate)
+            return estimate
+        except SQLAlchemyError as e:
+            raise e
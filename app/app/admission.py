@@ -0,0 +1,173 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from fastapi import HTTPException
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS, HTTP_503_SERVICE_UNAVAILABLE
+
+from .metrics import Counter, registry
+
+
+admission_rejected = registry.register(Counter(
+    'admission_rejected_total', 'Requests rejected by admission control',
+    ('name', 'reason'),
+))
+
+
+class TokenBucket():
+    """
+    Корзина токенов: пополняется со скоростью `rate` токенов в секунду до `capacity`
+    токенов, каждый запрос забирает один токен
+    """
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, rate: float, capacity: float, now: float) -> float:
+        """
+        Забрать токен. Возвращает 0, если токен есть, иначе число секунд до появления
+        токена
+        """
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class RateLimiter():
+    """
+    Набор корзин токенов по ключам (адрес клиента, email и т.п.). Число хранимых корзин
+    ограничено `maxsize`: давно не использованные корзины вытесняются, вытесненная
+    корзина при следующем запросе создается полной.
+    """
+
+    def __init__(self, rate: float, capacity: float, maxsize: int = 10000,
+                 timer: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.maxsize = maxsize
+        self.timer = timer
+        self._buckets: 'OrderedDict[Hashable, TokenBucket]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def take(self, key: Hashable) -> float:
+        """
+        Забрать токен из корзины ключа `key`. Возвращает 0, если запрос допущен, иначе
+        число секунд, через которое запрос можно повторить
+        """
+        if self.rate <= 0:
+            return 0.0
+        now = self.timer()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.capacity, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(self.rate, self.capacity, now)
+
+
+class Admission():
+    """
+    Допуск запросов к дорогим обработчикам. Запрос последовательно проходит:
+
+        - корзины токенов клиента (`clients`) и ключа запроса, например email (`keys`);
+          при исчерпании - ответ 429;
+        - ограничение числа одновременно обрабатываемых запросов `concurrency`; не
+          больше `max_queue` запросов ждут освобождения места не дольше `timeout`
+          секунд, остальные сразу получают ответ 503.
+
+    Оба ответа содержат заголовок `Retry-After`. Отклоненный запрос не занимает ни
+    соединения с БД, ни процессорного времени, поэтому остальные обработчики
+    сохраняют время ответа при перегрузке.
+    """
+
+    def __init__(self, name: str, concurrency: int, max_queue: int, timeout: float,
+                 clients: Optional[RateLimiter] = None, keys: Optional[RateLimiter] = None):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.clients = clients
+        self.keys = keys
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._active = 0
+        self._waiting = 0
+        self._counters = {
+            'admitted_total': 0,
+            'rate_limited_total': 0,
+            'queue_full_total': 0,
+            'queue_timeout_total': 0,
+        }
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        """Семафор, создается при первом обращении в цикле событий приложения"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def _reject(self, reason: str, status_code: int, detail: str, retry_after: float):
+        self._counters[f'{reason}_total'] += 1
+        admission_rejected.inc(self.name, reason)
+        raise HTTPException(status_code=status_code, detail=detail,
+                            headers={'Retry-After': str(max(math.ceil(retry_after), 1))})
+
+    def check_rate(self, client: Optional[str] = None, key: Optional[str] = None):
+        """Проверить корзины токенов клиента `client` и ключа `key`"""
+        for limiter, value in ((self.clients, client), (self.keys, key)):
+            if limiter is not None and value is not None:
+                retry_after = limiter.take(value)
+                if retry_after:
+                    self._reject('rate_limited', HTTP_429_TOO_MANY_REQUESTS,
+                                 'Too many requests', retry_after)
+
+    @asynccontextmanager
+    async def admit(self, client: Optional[str] = None, key: Optional[str] = None):
+        """Допустить запрос клиента `client` с ключом `key` на время блока `async with`"""
+        self.check_rate(client, key)
+        semaphore = self.semaphore
+        if semaphore.locked():
+            if self._waiting >= self.max_queue:
+                self._reject('queue_full', HTTP_503_SERVICE_UNAVAILABLE,
+                             'Service is overloaded', self.timeout)
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                self._reject('queue_timeout', HTTP_503_SERVICE_UNAVAILABLE,
+                             'Service is overloaded', self.timeout)
+            finally:
+                self._waiting -= 1
+        else:
+            await semaphore.acquire()
+        self._active += 1
+        self._counters['admitted_total'] += 1
+        try:
+            yield
+        finally:
+            self._active -= 1
+            semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """Число обрабатываемых и ожидающих запросов и накопленные счетчики"""
+        return {
+            'concurrency': self.concurrency,
+            'max_queue': self.max_queue,
+            'active': self._active,
+            'waiting': self._waiting,
+            'clients': len(self.clients) if self.clients is not None else 0,
+            'keys': len(self.keys) if self.keys is not None else 0,
+            **self._counters,
+        }
@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class TTLCache():
+    """
+    Ограниченный по размеру кэш в памяти процесса с вытеснением давно не использованных
+    записей (LRU) и временем жизни записей (TTL). Ведет счетчики попаданий и промахов.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, timer: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Получить значение по ключу `key`, если запись есть и не устарела"""
+        item = self._data.get(key)
+        if item is not None:
+            expires_at, value = item
+            if expires_at > self.timer():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """
+        Сохранить значение `value` по ключу `key` на `ttl` секунд (по умолчанию - на
+        время жизни кэша), при переполнении вытесняя давно не использованные записи
+        """
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (self.timer() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable):
+        """Удалить запись с ключом `key`"""
+        self._data.pop(key, None)
+
+    def clear(self):
+        """Удалить все записи"""
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Размер кэша и счетчики попаданий и промахов"""
+        requests = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / requests if requests else 0.0,
+        }
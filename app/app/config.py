@@ -1,4 +1,4 @@
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 from pydantic import BaseSettings, PostgresDsn, validator
 from dotenv import load_dotenv
 
@@ -17,6 +17,89 @@ class Settings(BaseSettings):
 
     SQLALCHEMY_DATABASE_URI: Optional[PostgresDsn] = None
 
+    # Реплики для чтения: адреса подключения (JSON-список), способ выбора реплики
+    # ('round_robin' или 'least_busy'), допустимое отставание и период проверки в секундах
+    SQLALCHEMY_REPLICA_URIS: List[str] = []
+    REPLICA_SELECTION: str = 'round_robin'
+    REPLICA_MAX_LAG: float = 5
+    REPLICA_CHECK_INTERVAL: float = 5
+
+    # Журнал запросов к БД: доля записываемых запросов (0 - только медленные), порог
+    # медленного запроса в миллисекундах и число запросов на HTTP-запрос, при превышении
+    # которого записывается предупреждение
+    QUERY_LOG_SAMPLE_RATE: float = 0.0
+    QUERY_LOG_SLOW_MS: float = 200
+    QUERY_BUDGET: int = 10
+
+    # Пул соединений с БД: число постоянных соединений, допустимое превышение,
+    # время ожидания свободного соединения и время жизни соединения в секундах
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30
+    DB_POOL_RECYCLE: int = 1800
+
+    # Запуск app.app.server: число процессов (по умолчанию - число CPU), время завершения
+    # начатых запросов при остановке в секундах, а также бюджет соединений с PostgreSQL
+    # (max_connections) и число соединений вне пулов приложения (миграции, psql и т.п.).
+    # Бюджет делится между процессами, DB_POOL_SIZE и DB_MAX_OVERFLOW уменьшаются до доли
+    # процесса
+    SERVER_WORKERS: Optional[int] = None
+    SERVER_DRAIN_TIMEOUT: float = 30
+    DB_MAX_CONNECTIONS: int = 100
+    DB_RESERVED_CONNECTIONS: int = 10
+
+    # Число соединений пула, открываемых при запуске приложения (не больше DB_POOL_SIZE,
+    # 0 - без прогрева)
+    DB_POOL_WARMUP: int = 2
+
+    # Пул хэширования паролей: 'thread' или 'process', число воркеров
+    # (по умолчанию - число CPU) и предельная глубина очереди ожидающих операций
+    HASHING_EXECUTOR: str = 'thread'
+    HASHING_WORKERS: Optional[int] = None
+    HASHING_MAX_QUEUE: int = 128
+
+    # Допуск запросов к POST /login и POST /users: число одновременно обрабатываемых
+    # запросов, число ожидающих запросов и предельное время ожидания в секундах, скорость
+    # (запросов в секунду, 0 - без ограничения) и запас корзин токенов для адреса клиента
+    # и для email, а также число хранимых корзин
+    ADMISSION_CONCURRENCY: int = 8
+    ADMISSION_MAX_QUEUE: int = 32
+    ADMISSION_TIMEOUT: float = 2
+    RATE_LIMIT_CLIENT_RATE: float = 5
+    RATE_LIMIT_CLIENT_BURST: int = 20
+    RATE_LIMIT_EMAIL_RATE: float = 0.5
+    RATE_LIMIT_EMAIL_BURST: int = 5
+    RATE_LIMIT_SIZE: int = 100000
+
+    # Кэш сведений об авторизованных пользователях: число записей и время жизни записи
+    # в секундах
+    PRINCIPAL_CACHE_SIZE: int = 10000
+    PRINCIPAL_CACHE_TTL: float = 30
+
+    # Кэш проверенных access токенов: число записей (запись живет до истечения токена)
+    TOKEN_CACHE_SIZE: int = 10000
+
+    # Авторизация без обращения к БД: права берутся из подписанного токена, отозванные
+    # токены определяются по списку отзыва, который обновляется из БД каждые
+    # REVOCATION_REFRESH_INTERVAL секунд
+    AUTH_STATELESS: bool = False
+    REVOCATION_REFRESH_INTERVAL: float = 10
+
+    # Время жизни оценки числа записей (count=estimated) в секундах
+    COUNT_ESTIMATE_TTL: float = 10
+
+    # Число строк, читаемых серверным курсором за одну выборку при выгрузке данных
+    EXPORT_FETCH_SIZE: int = 1000
+
+    # Отложенная запись времени последнего входа: период записи накопленных значений в
+    # секундах и число ожидающих записи пользователей, при котором запись начинается
+    # досрочно
+    ACTIVITY_FLUSH_INTERVAL: float = 5
+    ACTIVITY_BUFFER_SIZE: int = 10000
+
+    # Сериализация JSON-ответов: 'orjson' (если установлен) или 'json'
+    JSON_ENCODER: str = 'orjson'
+
     @validator("SQLALCHEMY_DATABASE_URI", pre=True)
     def assemble_db_connection(cls, v: Optional[str], values: Dict[str, Any]) -> Any:
         if isinstance(v, str):
@@ -29,6 +112,24 @@ class Settings(BaseSettings):
             path=f"/{values.get('POSTGRES_DB') or  ''}",
         )
 
+    @validator("HASHING_EXECUTOR")
+    def check_hashing_executor(cls, v: str) -> str:
+        if v not in ('thread', 'process'):
+            raise ValueError("HASHING_EXECUTOR must be 'thread' or 'process'")
+        return v
+
+    @validator("JSON_ENCODER")
+    def check_json_encoder(cls, v: str) -> str:
+        if v not in ('orjson', 'json'):
+            raise ValueError("JSON_ENCODER must be 'orjson' or 'json'")
+        return v
+
+    @validator("REPLICA_SELECTION")
+    def check_replica_selection(cls, v: str) -> str:
+        if v not in ('round_robin', 'least_busy'):
+            raise ValueError("REPLICA_SELECTION must be 'round_robin' or 'least_busy'")
+        return v
+
     class Config:
         case_sensitive = True
         env_file = "/code/.env"
@@ -0,0 +1,225 @@
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+
+# Границы корзин гистограмм задержки в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+def _labels(labelnames: Sequence[str], values: Sequence[Any]) -> str:
+    """Метки в формате Prometheus: {name="value",...}"""
+    if not labelnames:
+        return ''
+    pairs = (f'{name}="{str(value)}"' for name, value in zip(labelnames, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric():
+    """Базовый класс метрики с именем, описанием и именами меток"""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.documentation}',
+                          f'# TYPE {self.name} {self.type}', *self.samples()])
+
+
+class Counter(Metric):
+    """Монотонно возрастающий счетчик"""
+
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_labels(self.labelnames, labels)} {value}'
+                for labels, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """
+    Текущее значение. Значения берутся из функции `callback`, возвращающей словарь
+    {кортеж меток: значение}, в момент чтения метрик
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), *,
+                 callback: Callable[[], Dict[Tuple, float]]):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_labels(self.labelnames, labels)} {value}'
+                for labels, value in self.callback().items()]
+
+
+class Histogram(Metric):
+    """Гистограмма значений с фиксированными корзинами, суммой и числом наблюдений"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Метки -> [число наблюдений по корзинам (последняя - +Inf), сумма]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        item = self._values.get(labels)
+        if item is None:
+            item = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        item[0][bisect_left(self.buckets, value)] += 1
+        item[1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                bucket_labels = _labels((*self.labelnames, 'le'), (*labels, bound))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            label_text = _labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {total}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+class Registry():
+    """Набор метрик процесса, отдаваемый в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Зарегистрировать метрику; метрика с тем же именем возвращается повторно"""
+        return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+# Реестр метрик процесса
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route',
+    ('method', 'route', 'status'),
+))
+db_query_duration = registry.register(Histogram(
+    'db_query_duration_seconds', 'SQL statement execution time by statement type',
+    ('engine', 'statement'),
+))
+db_pool_wait = registry.register(Histogram(
+    'db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection',
+    ('engine',),
+))
+
+_pools: Dict[str, Any] = {}
+registry.register(Gauge(
+    'db_pool_connections', 'Pool connections by state', ('engine', 'state'),
+    callback=lambda: {
+        key: value
+        for name, pool in _pools.items()
+        for key, value in (((name, 'checked_out'), pool.checkedout()),
+                           ((name, 'idle'), pool.checkedin()),
+                           ((name, 'size'), pool.size()),
+                           ((name, 'overflow'), max(pool.overflow(), 0)))
+    },
+))
+
+# Типы запросов, используемые как значения метки statement
+STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'BEGIN', 'COMMIT', 'ROLLBACK')
+
+
+class TimedPool(AsyncAdaptedQueuePool):
+    """Пул соединений, измеряющий время ожидания свободного соединения"""
+
+    metrics_name = 'primary'
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_wait.observe(time.perf_counter() - start, self.metrics_name)
+
+
+def instrument_engine(engine, name: str = 'primary'):
+    """
+    Подключить сбор метрик к асинхронному движку `engine`: время выполнения запросов
+    по событиям курсора и, если движок создан с `poolclass=TimedPool`, время ожидания
+    и занятость соединений пула
+    """
+    sync_engine = engine.sync_engine
+    pool = sync_engine.pool
+    if isinstance(pool, TimedPool):
+        pool.metrics_name = name
+        _pools[name] = pool
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        keyword = (statement.lstrip()[:8].split(None, 1) or [''])[0].upper()
+        db_query_duration.observe(elapsed, name,
+                                  keyword if keyword in STATEMENTS else 'OTHER')
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get('query_start'):
+            context.connection.info['query_start'].pop()
+
+
+class TimedRoute(APIRoute):
+    """Маршрут FastAPI, измеряющий время обработки запроса"""
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        method = ','.join(sorted(self.methods))
+        route = self.path
+
+        async def timed_handler(request):
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            except HTTPException as e:
+                status = e.status_code
+                raise
+            except RequestValidationError:
+                # Обработчик ошибок приложения отвечает клиенту 422
+                status = 422
+                raise
+            finally:
+                request_duration.observe(time.perf_counter() - start, method, route, status)
+
+        return timed_handler
@@ -0,0 +1,274 @@
+import json
+from datetime import datetime, timezone
+from typing import Any, Collection, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+from sqlalchemy import Integer, String, bindparam, func, literal_column, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from .cache import TTLCache
+
+
+# Операторы фильтров спецификации запроса
+OPERATORS = ('eq', 'in', 'gt', 'gte', 'lt', 'lte', 'prefix', 'is_null')
+
+
+class Filter(BaseModel):
+    """Условие фильтрации: атрибут `attr`, оператор `op` и значение `value`"""
+    attr: str
+    op: str = 'eq'
+    value: Any = None
+
+
+class QuerySpec(BaseModel):
+    """
+    Декларативная спецификация запроса: фильтры, сортировка по нескольким атрибутам
+    (`-attr` - по убыванию) и набор выбираемых атрибутов (`fields`, None - объект целиком)
+    """
+    filters: List[Filter] = []
+    order_by: List[str] = []
+    fields: Optional[List[str]] = None
+
+
+def parse_bool(value: Any) -> bool:
+    """Привести значение `value` (true/false, 1/0, yes/no) к bool"""
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ('true', '1', 'yes'):
+        return True
+    if str(value).lower() in ('false', '0', 'no'):
+        return False
+    raise ValueError(f'Invalid boolean value: {value!r}')
+
+
+def coerce_value(column, value: Any) -> Any:
+    """
+    Привести значение `value`, полученное из строки запроса или JSON, к python-типу
+    колонки `column`. При невозможности приведения возбуждается ValueError. Время без
+    часового пояса для колонок с часовым поясом считается временем UTC.
+    """
+    python_type = column.type.python_type
+    if value is None:
+        return value
+    try:
+        if python_type is datetime:
+            if not isinstance(value, datetime):
+                value = datetime.fromisoformat(value)
+            if getattr(column.type, 'timezone', False) and value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            return value
+        if isinstance(value, python_type):
+            return value
+        if python_type is bool:
+            return parse_bool(value)
+        return python_type(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid value for {column.key}: {value!r}')
+
+
+def parse_filter(expression: str) -> Filter:
+    """
+    Разобрать фильтр из строки запроса вида `attr:op:value`; значения оператора `in`
+    перечисляются через запятую, значение оператора `is_null` - true или false
+    """
+    parts = expression.split(':', 2)
+    if len(parts) != 3:
+        raise ValueError(f'Invalid filter: {expression!r}')
+    attr, op, value = parts
+    return Filter(attr=attr, op=op, value=value.split(',') if op == 'in' else value)
+
+
+def parse_order_by(expression: Optional[str]) -> List[str]:
+    """Разобрать сортировку из строки запроса вида `-created,id`"""
+    return [item.strip() for item in (expression or '').split(',') if item.strip()]
+
+
+def parse_fields(expression: Optional[str]) -> Optional[List[str]]:
+    """Разобрать набор атрибутов из строки запроса вида `id,email`, None - объект целиком"""
+    return parse_order_by(expression) or None
+
+
+class explain(Executable, ClauseElement):
+    """Выражение EXPLAIN (FORMAT JSON) для запроса `statement`: план без выполнения"""
+
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(explain, 'postgresql')
+def _compile_explain(element, compiler, **kwargs):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kwargs)
+
+
+def plan_rows(plan: Any) -> float:
+    """
+    Оценка числа строк из результата EXPLAIN (FORMAT JSON) `plan` (строка JSON или
+    разобранный список) - число строк верхнего узла плана
+    """
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    return plan[0]['Plan']['Plan Rows']
+
+
+class QueryCompiler():
+    """
+    Компилятор спецификаций запроса в выражения SQLAlchemy. Выражения кэшируются по
+    форме спецификации (атрибуты, операторы, сортировка, набор атрибутов), значения
+    фильтров передаются параметрами, поэтому повторные запросы той же формы не строят
+    выражение заново.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self._statements = TTLCache(maxsize, float('inf'))
+
+    def _column(self, model, attr: str, allowed: Optional[Collection[str]]):
+        """Колонка атрибута `attr` объекта `model` из числа разрешенных `allowed`"""
+        column = model.__table__.columns.get(attr)
+        if column is None or (allowed is not None and attr not in allowed):
+            raise ValueError(f'Attribute is not allowed: {attr!r}')
+        return getattr(model, attr)
+
+    def _filter(self, statement: Select, model, spec: QuerySpec,
+                allowed: Optional[Collection[str]], null_checks: Dict[int, bool]) -> Select:
+        """Добавить к выражению `statement` фильтры спецификации `spec`"""
+        for index, item in enumerate(spec.filters):
+            column = self._column(model, item.attr, allowed)
+            name = f'p{index}'
+            if item.op == 'eq':
+                statement = statement.filter(column == bindparam(name, type_=column.type))
+            elif item.op == 'in':
+                statement = statement.filter(
+                    column.in_(bindparam(name, type_=column.type, expanding=True))
+                )
+            elif item.op == 'gt':
+                statement = statement.filter(column > bindparam(name, type_=column.type))
+            elif item.op == 'gte':
+                statement = statement.filter(column >= bindparam(name, type_=column.type))
+            elif item.op == 'lt':
+                statement = statement.filter(column < bindparam(name, type_=column.type))
+            elif item.op == 'lte':
+                statement = statement.filter(column <= bindparam(name, type_=column.type))
+            elif item.op == 'prefix':
+                if not isinstance(column.type, String):
+                    raise ValueError(f'Operator prefix is not allowed for {item.attr!r}')
+                statement = statement.filter(
+                    column.like(bindparam(name, type_=column.type), escape='\\')
+                )
+            else:
+                statement = statement.filter(column.is_(None) if null_checks[index] else
+                                             column.isnot(None))
+        return statement
+
+    def _build(self, model, spec: QuerySpec, allowed: Optional[Collection[str]],
+               null_checks: Dict[int, bool]) -> Select:
+        """Построить выражение для спецификации `spec`"""
+        if spec.fields:
+            statement = select(*(self._column(model, attr, allowed) for attr in spec.fields))
+        else:
+            statement = select(model)
+        statement = self._filter(statement, model, spec, allowed, null_checks)
+        for attr in spec.order_by:
+            column = self._column(model, attr.lstrip('-'), allowed)
+            statement = statement.order_by(column.desc() if attr.startswith('-') else column)
+        return statement.offset(
+            bindparam('_skip', type_=Integer)
+        ).limit(
+            bindparam('_limit', type_=Integer)
+        )
+
+    def _params(self, model, spec: QuerySpec) -> Dict[str, Any]:
+        """Значения параметров фильтров спецификации `spec`"""
+        params = {}
+        for index, item in enumerate(spec.filters):
+            column = model.__table__.columns[item.attr]
+            if item.op == 'in':
+                values = item.value if isinstance(item.value, (list, tuple)) else [item.value]
+                params[f'p{index}'] = [coerce_value(column, value) for value in values]
+            elif item.op == 'prefix':
+                value = str(item.value)
+                value = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                params[f'p{index}'] = value + '%'
+            elif item.op != 'is_null':
+                params[f'p{index}'] = coerce_value(column, item.value)
+        return params
+
+    def _prepare(self, model, spec: QuerySpec, allowed: Optional[Collection[str]]):
+        """Проверить операторы спецификации `spec` и получить ее форму для кэша"""
+        for item in spec.filters:
+            if item.op not in OPERATORS:
+                raise ValueError(f'Invalid operator: {item.op!r}')
+        # Значение is_null определяет текст запроса, поэтому входит в форму спецификации
+        null_checks = {index: parse_bool(item.value)
+                       for index, item in enumerate(spec.filters) if item.op == 'is_null'}
+        shape = (
+            model,
+            tuple((item.attr, item.op, null_checks.get(index))
+                  for index, item in enumerate(spec.filters)),
+            tuple(spec.order_by),
+            tuple(spec.fields or ()),
+            frozenset(allowed) if allowed is not None else None,
+        )
+        return shape, null_checks
+
+    def compile(self, model, spec: QuerySpec, *,
+                allowed: Optional[Collection[str]] = None) -> Tuple[Select, Dict[str, Any]]:
+        """
+        Получить выражение и параметры для спецификации `spec` по объекту `model`,
+        допуская только атрибуты из `allowed` (None - все колонки). Выражение берется из
+        кэша, если запрос той же формы уже компилировался. Параметры `_skip` и `_limit`
+        задает вызывающий код.
+        """
+        shape, null_checks = self._prepare(model, spec, allowed)
+        statement = self._statements.get(shape)
+        if statement is None:
+            statement = self._build(model, spec, allowed, null_checks)
+            self._statements.set(shape, statement)
+        return statement, self._params(model, spec)
+
+    def compile_count(self, model, spec: QuerySpec, *,
+                      allowed: Optional[Collection[str]] = None
+                      ) -> Tuple[Select, Dict[str, Any]]:
+        """
+        Получить выражение SELECT count(*) с фильтрами спецификации `spec` и его
+        параметры. Сортировка и набор атрибутов спецификации не учитываются.
+        """
+        spec = QuerySpec(filters=spec.filters)
+        shape, null_checks = self._prepare(model, spec, allowed)
+        shape = ('count', *shape)
+        statement = self._statements.get(shape)
+        if statement is None:
+            statement = self._filter(select(func.count()).select_from(model), model, spec,
+                                     allowed, null_checks)
+            self._statements.set(shape, statement)
+        return statement, self._params(model, spec)
+
+    def compile_estimate(self, model, spec: QuerySpec, *,
+                         allowed: Optional[Collection[str]] = None
+                         ) -> Tuple[explain, Dict[str, Any]]:
+        """
+        Получить выражение EXPLAIN для выборки записей с фильтрами спецификации `spec` и
+        его параметры. Запрос не агрегируется, поэтому число строк верхнего узла
+        плана (`plan_rows`) - оценка числа подходящих записей и для параллельного плана
+        (узел Gather суммирует строки воркеров).
+        """
+        spec = QuerySpec(filters=spec.filters)
+        shape, null_checks = self._prepare(model, spec, allowed)
+        shape = ('estimate', *shape)
+        statement = self._statements.get(shape)
+        if statement is None:
+            # Колонка без типа: типы выбранных колонок применялись бы к строке плана
+            statement = explain(self._filter(select(literal_column('1')).select_from(model),
+                                             model, spec, allowed, null_checks))
+            self._statements.set(shape, statement)
+        return statement, self._params(model, spec)
+
+    def stats(self) -> Dict[str, Any]:
+        """Размер кэша выражений и счетчики попаданий и промахов"""
+        return self._statements.stats()
+
+
+# Экземпляр компилятора спецификаций для использования в BaseActions
+query_compiler = QueryCompiler()
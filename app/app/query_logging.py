@@ -0,0 +1,130 @@
+import json
+import logging
+import random
+import time
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from sqlalchemy import event
+
+from .metrics import Histogram, registry
+
+
+logger = logging.getLogger('app.sql')
+
+queries_per_request = registry.register(Histogram(
+    'db_queries_per_request', 'Number of SQL statements executed per HTTP request',
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100),
+))
+
+
+def _shape(value: Any) -> str:
+    """Тип значения параметра без самого значения: str, int, list[3] и т.п."""
+    if isinstance(value, (list, tuple)):
+        return f'{type(value).__name__}[{len(value)}]'
+    return type(value).__name__
+
+
+def parameters_shape(parameters: Any, executemany: bool = False) -> Any:
+    """
+    Форма параметров запроса: типы значений по именам или позициям. Значения не
+    попадают в журнал, чтобы в него не попадали пароли и персональные данные.
+    """
+    if executemany and parameters:
+        return {'rows': len(parameters), 'row': parameters_shape(parameters[0])}
+    if isinstance(parameters, dict):
+        return {name: _shape(value) for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_shape(value) for value in parameters]
+    return None
+
+
+class RequestQueries():
+    """Число и суммарное время запросов к БД, выполненных при обработке запроса"""
+
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+class QueryLogger():
+    """
+    Структурированный журнал запросов к БД вместо `echo=True`: в журнал `app.sql`
+    записывается доля `sample_rate` запросов (уровень INFO) и все запросы дольше
+    `slow_threshold` секунд (уровень WARNING) с формой параметров. Запросы считаются
+    по HTTP-запросам: при превышении `budget` записывается предупреждение.
+    """
+
+    def __init__(self, sample_rate: float = 0.0, slow_threshold: float = 0.2,
+                 budget: int = 10):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.budget = budget
+        self._current: ContextVar[Optional[RequestQueries]] = ContextVar(
+            'request_queries', default=None
+        )
+
+    def instrument(self, engine, name: str = 'primary'):
+        """Подключить журнал к асинхронному движку `engine`"""
+        sync_engine = engine.sync_engine
+
+        @event.listens_for(sync_engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('query_log_start', []).append(time.perf_counter())
+
+        @event.listens_for(sync_engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info['query_log_start'].pop()
+            queries = self._current.get()
+            if queries is not None:
+                queries.count += 1
+                queries.seconds += elapsed
+            if elapsed >= self.slow_threshold:
+                self._log(logging.WARNING, 'slow_query', name, statement, parameters,
+                          executemany, elapsed)
+            elif self.sample_rate and random.random() < self.sample_rate:
+                self._log(logging.INFO, 'query', name, statement, parameters,
+                          executemany, elapsed)
+
+        @event.listens_for(sync_engine, 'handle_error')
+        def handle_error(context):
+            if (context.connection is not None and
+                    context.connection.info.get('query_log_start')):
+                context.connection.info['query_log_start'].pop()
+
+    def _log(self, level: int, kind: str, engine_name: str, statement: str,
+             parameters: Any, executemany: bool, elapsed: float):
+        if not logger.isEnabledFor(level):
+            return
+        logger.log(level, json.dumps({
+            'event': kind,
+            'engine': engine_name,
+            'duration_ms': round(elapsed * 1000, 3),
+            'statement': ' '.join(statement.split())[:1000],
+            'parameters': parameters_shape(parameters, executemany),
+        }))
+
+    def start_request(self):
+        """Начать подсчет запросов к БД для текущего HTTP-запроса"""
+        return self._current.set(RequestQueries())
+
+    def finish_request(self, token, method: str, path: str) -> RequestQueries:
+        """
+        Завершить подсчет запросов к БД для HTTP-запроса `method` `path` и записать
+        предупреждение, если их число превысило бюджет
+        """
+        queries = self._current.get()
+        self._current.reset(token)
+        queries_per_request.observe(queries.count)
+        if queries.count > self.budget:
+            logger.warning(json.dumps({
+                'event': 'query_budget_exceeded',
+                'method': method,
+                'path': path,
+                'queries': queries.count,
+                'budget': self.budget,
+                'db_ms': round(queries.seconds * 1000, 3),
+            }))
+        return queries
@@ -0,0 +1,139 @@
+import asyncio
+import itertools
+from typing import Any, Dict, List, Optional, Sequence
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+
+# Отставание реплики в секундах: 0, если реплика применила все полученные изменения
+LAG_QUERY = text(
+    'SELECT CASE WHEN NOT pg_is_in_recovery() '
+    'OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END'
+)
+
+
+class Replica():
+    """Реплика БД: движок и результат последней проверки"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = False
+        self.lag: Optional[float] = None
+        self.reads_total = 0
+
+    @property
+    def busy(self) -> int:
+        """Число занятых соединений пула"""
+        return self.engine.sync_engine.pool.checkedout()
+
+
+class ReplicaPool():
+    """
+    Набор реплик БД для чтения. Реплика выбирается по кругу (`round_robin`) или по
+    наименьшему числу занятых соединений (`least_busy`) среди исправных реплик.
+    Реплика считается исправной, если последняя проверка прошла успешно и ее отставание
+    не больше `max_lag` секунд. Если исправных реплик нет, чтение выполняется на
+    основной БД.
+    """
+
+    def __init__(self, engines: Sequence[Any], selection: str = 'round_robin',
+                 max_lag: float = 5, interval: float = 5, timeout: float = 2):
+        self.replicas = [Replica(engine) for engine in engines]
+        self.selection = selection
+        self.max_lag = max_lag
+        self.interval = interval
+        self.timeout = timeout
+        self.fallbacks_total = 0
+        self._counter = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+
+    def __bool__(self) -> bool:
+        return bool(self.replicas)
+
+    def choose(self):
+        """Движок реплики для очередного чтения или None, если исправных реплик нет"""
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            self.fallbacks_total += 1
+            return None
+        if self.selection == 'least_busy':
+            replica = min(healthy, key=lambda replica: replica.busy)
+        else:
+            replica = healthy[next(self._counter) % len(healthy)]
+        replica.reads_total += 1
+        return replica.engine
+
+    async def check(self, replica: Replica):
+        """Проверить доступность и отставание реплики `replica`"""
+        try:
+            async with replica.engine.connect() as conn:
+                lag = await asyncio.wait_for(conn.scalar(LAG_QUERY), self.timeout)
+            replica.lag = float(lag)
+            replica.healthy = replica.lag <= self.max_lag
+        except Exception:
+            replica.healthy = False
+
+    async def check_all(self):
+        """Проверить все реплики"""
+        await asyncio.gather(*(self.check(replica) for replica in self.replicas))
+
+    async def _run(self):
+        """Периодическая проверка реплик"""
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check_all()
+
+    async def start(self):
+        """Проверить реплики и запустить их периодическую проверку"""
+        if self.replicas:
+            await self.check_all()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить проверку реплик и закрыть их соединения"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние реплик и число чтений, выполненных на основной БД из-за их отказа"""
+        replicas: List[Dict[str, Any]] = [
+            {'healthy': replica.healthy, 'lag': replica.lag, 'busy': replica.busy,
+             'reads_total': replica.reads_total}
+            for replica in self.replicas
+        ]
+        return {'selection': self.selection, 'replicas': replicas,
+                'fallbacks_total': self.fallbacks_total}
+
+
+class RoutingSession(Session):
+    """
+    Сессия, направляющая запросы, помеченные параметром выполнения `replica=True`, на
+    реплики из `replicas`. Все остальные запросы выполняются на основной БД. После
+    первой записи (flush или INSERT/UPDATE/DELETE) все запросы сессии, включая чтение,
+    выполняются на основной БД, чтобы сессия видела собственные изменения.
+    """
+
+    def __init__(self, *args, replicas: Optional[ReplicaPool] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replicas = replicas
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['primary'] = True
+        elif (self.replicas and not self.info.get('primary') and
+                getattr(clause, 'get_execution_options', None) is not None and
+                clause.get_execution_options().get('replica')):
+            engine = self.replicas.choose()
+            if engine is not None:
+                return engine.sync_engine
+        return super().get_bind(mapper, clause=clause, **kwargs)
@@ -0,0 +1,62 @@
+import json
+import operator
+from datetime import date, datetime, time
+from decimal import Decimal
+from enum import Enum
+from typing import Any, Callable, Dict, Type
+from uuid import UUID
+
+from pydantic import BaseModel
+from starlette.responses import JSONResponse
+
+from .config import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    """Представление в JSON типов, не поддерживаемых модулем json"""
+    if isinstance(obj, (UUID, Decimal)):
+        return str(obj)
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Сериализовать `content` в JSON: orjson, если он установлен и выбран параметром
+    `JSON_ENCODER`, иначе стандартным модулем json. UUID и даты сериализуются в строки.
+    """
+    if orjson is not None and settings.JSON_ENCODER == 'orjson':
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, allow_nan=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON-ответ, сериализуемый функцией `dumps`"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def compile_serializer(schema: Type[BaseModel]) -> Callable[[Any], Dict[str, Any]]:
+    """
+    Получить функцию, преобразующую объект ORM в словарь с полями схемы `schema` без
+    валидации pydantic: атрибуты читаются одним заранее построенным attrgetter.
+    Применяется к данным из БД, которые уже соответствуют типам схемы.
+    """
+    fields = list(schema.__fields__.values())
+    names = tuple(field.alias for field in fields)
+    getter = operator.attrgetter(*(field.name for field in fields))
+    if len(fields) == 1:
+        return lambda obj: {names[0]: getter(obj)}
+    return lambda obj: dict(zip(names, getter(obj)))
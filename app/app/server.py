@@ -0,0 +1,112 @@
+import argparse
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from uvicorn import Config, Server
+from uvicorn.supervisors.multiprocess import Multiprocess
+
+
+logger = logging.getLogger('uvicorn.error')
+
+
+def cpu_count() -> int:
+    """Число CPU, доступных процессу"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def pool_limits(workers: int, max_connections: int, reserved: int, pool_size: int,
+                max_overflow: int) -> Tuple[int, int]:
+    """
+    Размер пула и допустимое превышение для одного процесса: соединения пулов всех
+    `workers` процессов вместе не превышают `max_connections - reserved`. Заданные
+    `pool_size` и `max_overflow` уменьшаются, только если не помещаются в долю процесса.
+    """
+    share = (max_connections - reserved) // workers
+    if share < 1:
+        raise ValueError(f'{max_connections - reserved} connections cannot be shared '
+                         f'by {workers} workers')
+    pool_size = min(pool_size, share)
+    return pool_size, min(max_overflow, share - pool_size)
+
+
+def worker_environ(workers: int, cpus: int) -> Dict[str, str]:
+    """
+    Параметры `app.app.config` для процессов-воркеров: доля бюджета соединений с БД и,
+    если размер пула хэширования не задан, доля CPU для хэширования паролей
+    """
+    # Настройки читаются при вызове: модуль импортируется и без переменных окружения БД
+    from .config import settings
+
+    pool_size, max_overflow = pool_limits(workers, settings.DB_MAX_CONNECTIONS,
+                                          settings.DB_RESERVED_CONNECTIONS,
+                                          settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW)
+    environ = {'DB_POOL_SIZE': str(pool_size), 'DB_MAX_OVERFLOW': str(max_overflow)}
+    if settings.HASHING_WORKERS is None:
+        environ['HASHING_WORKERS'] = str(max(cpus // workers, 1))
+    return environ
+
+
+class Supervisor(Multiprocess):
+    """
+    Родительский процесс uvicorn. По SIGTERM или SIGINT передает SIGTERM воркерам:
+    каждый воркер перестает принимать соединения, завершает начатые запросы и
+    выполняет обработчики shutdown приложения. Воркеры, не завершившиеся за
+    `drain_timeout` секунд, останавливаются принудительно.
+    """
+
+    def __init__(self, *args, drain_timeout: float = 30, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.drain_timeout = drain_timeout
+
+    def shutdown(self):
+        for process in self.processes:
+            process.terminate()
+        deadline = time.monotonic() + self.drain_timeout
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning('Killing worker process [%s] after %s s drain timeout',
+                               process.pid, self.drain_timeout)
+                process.kill()
+                process.join()
+        logger.info('Stopping parent process [%s]', self.pid)
+
+
+def run(app: str, host: str = '127.0.0.1', port: int = 8000, workers: Optional[int] = None,
+        drain_timeout: float = 30):
+    """
+    Запустить приложение `app` ('module:attribute') в `workers` процессах uvicorn
+    (по умолчанию - по числу CPU) с общим сокетом и бюджетом соединений с БД
+    """
+    cpus = cpu_count()
+    workers = workers or cpus
+    # Воркеры запускаются через spawn и читают настройки из переменных окружения
+    os.environ.update(worker_environ(workers, cpus))
+    config = Config(app, host=host, port=port, workers=workers, lifespan='on',
+                    server_header=False)
+    server = Server(config=config)
+    sock = config.bind_socket()
+    logger.info('Starting %s workers, %s+%s database connections each', workers,
+                os.environ['DB_POOL_SIZE'], os.environ['DB_MAX_OVERFLOW'])
+    Supervisor(config, target=server.run, sockets=[sock], drain_timeout=drain_timeout).run()
+
+
+def main():
+    from .config import settings
+
+    parser = argparse.ArgumentParser(description='Run an ASGI application in worker processes')
+    parser.add_argument('app', help="application import string, e.g. 'accounts.main:app'")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=settings.SERVER_WORKERS)
+    parser.add_argument('--drain-timeout', type=float, default=settings.SERVER_DRAIN_TIMEOUT)
+    args = parser.parse_args()
+    run(args.app, args.host, args.port, args.workers, args.drain_timeout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import asyncio
+from typing import Any, Dict, Hashable, Optional
+
+from .actions import BaseActions
+
+
+class WriteBehindBuffer():
+    """
+    Буфер отложенной записи служебных атрибутов (например, времени последнего входа).
+    Значения накапливаются в памяти процесса, повторные изменения одной записи
+    объединяются, и накопленное периодически записывается в БД пакетными запросами
+    UPDATE ... FROM (VALUES ...). При остановке буфер записывается в БД.
+    """
+
+    def __init__(self, model, interval: float, max_size: int = 10000,
+                 chunk_size: int = 1000):
+        self.model = model
+        self.interval = interval
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self._pending: Dict[Hashable, Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._session_factory = None
+        self._stopping = False
+        self._counters = {
+            'put_total': 0,
+            'flush_total': 0,
+            'flushed_rows_total': 0,
+            'flush_errors_total': 0,
+        }
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def put(self, id: Hashable, values: Dict[str, Any]):
+        """Отложить запись значений `values` в запись с идентификатором `id`"""
+        self._pending.setdefault(id, {}).update(values)
+        self._counters['put_total'] += 1
+        if len(self._pending) >= self.max_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self, db) -> int:
+        """
+        Записать накопленные значения в БД `db`. При ошибке или отмене записи значения
+        возвращаются в буфер, не перезаписывая поступившие за время записи. Возвращает
+        число записанных строк.
+        """
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        # Строки одного запроса должны содержать одинаковый набор атрибутов
+        groups: Dict[tuple, list] = {}
+        for id, values in pending.items():
+            groups.setdefault(tuple(sorted(values)), []).append({'id': id, **values})
+        flushed = 0
+        done = False
+        try:
+            for rows in groups.values():
+                # Служебные атрибуты не кэшируются, поэтому обработчики изменений не
+                # оповещаются
+                flushed += await BaseActions().update_from_values(
+                    self.model, rows, db, chunk_size=self.chunk_size, notify=False
+                )
+            done = True
+        except Exception:
+            self._counters['flush_errors_total'] += 1
+            raise
+        finally:
+            # CancelledError не является Exception: значения возвращаются и при отмене
+            if not done:
+                for id, values in pending.items():
+                    self._pending[id] = {**values, **self._pending.get(id, {})}
+        self._counters['flush_total'] += 1
+        self._counters['flushed_rows_total'] += flushed
+        return flushed
+
+    async def _run(self):
+        """Периодическая запись буфера до вызова `stop`"""
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping:
+                break
+            try:
+                async with self._session_factory() as db:
+                    await self.flush(db)
+            except Exception:
+                # Значения остались в буфере и будут записаны при следующей попытке
+                pass
+
+    async def start(self, session_factory):
+        """Запустить периодическую запись буфера"""
+        self._session_factory = session_factory
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Остановить периодическую запись и записать оставшиеся значения. Начатая запись
+        не отменяется: остановка дожидается ее завершения.
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+            async with self._session_factory() as db:
+                await self.flush(db)
+
+    def stats(self) -> Dict[str, Any]:
+        """Число ожидающих записи строк и накопленные счетчики"""
+        return {'pending': len(self._pending), **self._counters}
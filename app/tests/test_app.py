@@ -1 +1,269 @@
+import asyncio
+import json
+import logging
 
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import Boolean, Column, Integer, String, create_engine, select, text, update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.declarative import declarative_base
+
+from app.admission import Admission, RateLimiter
+from app.cache import TTLCache
+from app.metrics import Counter, Histogram, Registry, TimedRoute, request_duration
+from app.query_logging import QueryLogger, parameters_shape
+from app.query import QueryCompiler, QuerySpec, Filter, explain, parse_filter, plan_rows
+from app.replicas import ReplicaPool, RoutingSession
+from app.server import pool_limits
+
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = 'items'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    is_active = Column(Boolean)
+
+
+class Timer():
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Engine():
+    """Движок реплики с заданным числом занятых соединений"""
+
+    def __init__(self, busy=0):
+        self.sync_engine = create_engine('sqlite://')
+        self.sync_engine.pool.checkedout = lambda: busy
+
+
+class TestCache:
+
+    def test_ttl(self):
+        timer = Timer()
+        cache = TTLCache(maxsize=10, ttl=5, timer=timer)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=1)
+        assert cache.get('a') == 1
+        timer.now = 2
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        timer.now = 6
+        assert cache.get('a') is None
+        assert cache.stats()['hits'] == 2
+        assert cache.stats()['misses'] == 2
+
+    def test_lru(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert cache.stats()['evictions'] == 1
+        cache.pop('a')
+        assert len(cache) == 1
+
+
+class TestQuery:
+
+    def test_compile(self):
+        compiler = QueryCompiler()
+        spec = QuerySpec(filters=[parse_filter('name:prefix:a_b'),
+                                  parse_filter('id:in:1,2'),
+                                  Filter(attr='is_active', op='is_null', value='false')],
+                         order_by=['-id', 'name'])
+        statement, params = compiler.compile(Item, spec)
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+        assert 'items.name LIKE' in sql
+        assert 'items.is_active IS NOT NULL' in sql
+        assert 'ORDER BY items.id DESC, items.name' in sql
+        assert params == {'p0': 'a\\_b%', 'p1': [1, 2]}
+
+        same_statement, params = compiler.compile(Item, QuerySpec(
+            filters=[parse_filter('name:prefix:c'), parse_filter('id:in:3'),
+                     Filter(attr='is_active', op='is_null', value=False)],
+            order_by=['-id', 'name']
+        ))
+        assert same_statement is statement
+        assert params == {'p0': 'c%', 'p1': [3]}
+        assert compiler.stats()['hits'] == 1
+
+    def test_compile_count(self):
+        compiler = QueryCompiler()
+        spec = QuerySpec(filters=[parse_filter('id:gt:1')], order_by=['-id'], fields=['id'])
+        statement, params = compiler.compile_count(Item, spec)
+        sql = str(explain(statement).compile(dialect=postgresql.dialect()))
+        assert sql.startswith('EXPLAIN (FORMAT JSON) SELECT count(*) AS count_1')
+        assert 'WHERE items.id >' in sql and 'ORDER BY' not in sql
+        assert params == {'p0': 1}
+        assert compiler.compile_count(Item, QuerySpec(filters=spec.filters))[0] is statement
+
+    def test_compile_estimate(self):
+        compiler = QueryCompiler()
+        spec = QuerySpec(filters=[parse_filter('name:prefix:a')], order_by=['-id'])
+        statement, params = compiler.compile_estimate(Item, spec)
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+        assert sql.startswith('EXPLAIN (FORMAT JSON) SELECT 1 \nFROM items')
+        assert 'count' not in sql and 'ORDER BY' not in sql
+        assert params == {'p0': 'a%'}
+        assert compiler.compile_estimate(Item, spec)[0] is statement
+
+    def test_plan_rows(self):
+        # Параллельный план неагрегированной выборки: оценка у узла Gather, а не у воркеров
+        plan = [{'Plan': {'Node Type': 'Gather', 'Plan Rows': 500000, 'Workers Planned': 2,
+                          'Plans': [{'Node Type': 'Seq Scan', 'Parallel Aware': True,
+                                     'Plan Rows': 208333}]}}]
+        assert plan_rows(json.dumps(plan)) == 500000
+        assert plan_rows([{'Plan': {'Node Type': 'Index Scan', 'Plan Rows': 3}}]) == 3
+
+    def test_allowed(self):
+        compiler = QueryCompiler()
+        with pytest.raises(ValueError):
+            compiler.compile(Item, QuerySpec(filters=[parse_filter('name:eq:a')]),
+                             allowed=('id',))
+        with pytest.raises(ValueError):
+            compiler.compile(Item, QuerySpec(filters=[parse_filter('id:eq:a')]))
+        with pytest.raises(ValueError):
+            compiler.compile(Item, QuerySpec(filters=[parse_filter('id:prefix:1')]))
+
+
+class TestReplicas:
+
+    def test_choose(self):
+        replicas = ReplicaPool([Engine(busy=2), Engine(busy=1)])
+        assert replicas.choose() is None
+        assert replicas.fallbacks_total == 1
+        for replica in replicas.replicas:
+            replica.healthy = True
+        first, second = replicas.choose(), replicas.choose()
+        assert first is not second
+        replicas.selection = 'least_busy'
+        assert replicas.choose() is replicas.replicas[1].engine
+
+    def test_routing(self):
+        primary = create_engine('sqlite://')
+        replicas = ReplicaPool([Engine()])
+        replicas.replicas[0].healthy = True
+        session = RoutingSession(bind=primary, replicas=replicas)
+        read = select(Item).execution_options(replica=True)
+        assert session.get_bind(clause=select(Item)) is primary
+        assert session.get_bind(clause=read) is replicas.replicas[0].engine.sync_engine
+        assert session.get_bind(clause=update(Item).values(name='x')) is primary
+        assert session.get_bind(clause=read) is primary
+
+
+class TestMetrics:
+
+    def test_render(self):
+        registry = Registry()
+        histogram = registry.register(Histogram('latency_seconds', 'Latency', ('route',),
+                                                buckets=(0.1, 1.0)))
+        counter = registry.register(Counter('errors_total', 'Errors'))
+        histogram.observe(0.05, '/users')
+        histogram.observe(0.5, '/users')
+        histogram.observe(5, '/users')
+        counter.inc()
+        text = registry.render()
+        assert 'latency_seconds_bucket{route="/users",le="0.1"} 1' in text
+        assert 'latency_seconds_bucket{route="/users",le="1.0"} 2' in text
+        assert 'latency_seconds_bucket{route="/users",le="+Inf"} 3' in text
+        assert 'latency_seconds_count{route="/users"} 3' in text
+        assert 'errors_total 1' in text
+        assert registry.register(Counter('errors_total', 'Errors')) is counter
+
+    def test_timed_route(self):
+        app = FastAPI()
+        app.router.route_class = TimedRoute
+
+        @app.post('/items/{id}')
+        async def create_item(id: int):
+            return {'id': id}
+
+        with TestClient(app) as client:
+            assert client.post('/items/1').status_code == 200
+            assert client.post('/items/a').status_code == 422
+        text = request_duration.render()
+        assert 'route="/items/{id}",status="200"' in text
+        assert 'route="/items/{id}",status="422"' in text
+
+
+class TestQueryLogging:
+
+    def test_shape(self):
+        assert parameters_shape(('secret', 1, [1, 2])) == ['str', 'int', 'list[2]']
+        assert parameters_shape({'email': 'a@b.c'}) == {'email': 'str'}
+        assert parameters_shape([(1,), (2,)], executemany=True) == {
+            'rows': 2, 'row': ['int']}
+
+    def test_budget(self, caplog):
+        engine = Engine()
+        query_logger = QueryLogger(budget=1)
+        query_logger.instrument(engine)
+        token = query_logger.start_request()
+        with engine.sync_engine.connect() as conn:
+            conn.execute(text('SELECT 1'))
+            conn.execute(text('SELECT 2'))
+        with caplog.at_level(logging.WARNING, logger='app.sql'):
+            queries = query_logger.finish_request(token, 'GET', '/users')
+        assert queries.count == 2
+        assert 'query_budget_exceeded' in caplog.text
+
+
+class TestAdmission:
+
+    def test_rate_limiter(self):
+        timer = Timer()
+        limiter = RateLimiter(rate=1, capacity=2, maxsize=1, timer=timer)
+        assert limiter.take('a') == 0
+        assert limiter.take('a') == 0
+        assert limiter.take('a') == pytest.approx(1)
+        timer.now = 1.0
+        assert limiter.take('a') == 0
+        limiter.take('b')
+        assert len(limiter) == 1
+
+    def test_admit(self):
+
+        async def scenario():
+            admission = Admission('test', concurrency=1, max_queue=1, timeout=0.05)
+            async with admission.admit():
+                waiting = asyncio.ensure_future(admission.admit().__aenter__())
+                await asyncio.sleep(0)
+                with pytest.raises(HTTPException) as error:
+                    async with admission.admit():
+                        pass
+                assert error.value.status_code == 503
+                assert error.value.headers['Retry-After'] == '1'
+                with pytest.raises(HTTPException):
+                    await waiting
+            async with admission.admit():
+                pass
+            return admission.stats()
+
+        stats = asyncio.run(scenario())
+        assert stats['queue_full_total'] == 1
+        assert stats['queue_timeout_total'] == 1
+        assert stats['admitted_total'] == 2
+        assert stats['active'] == stats['waiting'] == 0
+
+
+class TestServer:
+
+    def test_pool_limits(self):
+        assert pool_limits(2, 100, 10, 5, 10) == (5, 10)
+        assert pool_limits(8, 100, 10, 5, 10) == (5, 6)
+        assert pool_limits(32, 100, 10, 5, 10) == (2, 0)
+        with pytest.raises(ValueError):
+            pool_limits(100, 100, 10, 5, 10)